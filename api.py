@@ -0,0 +1,393 @@
+"""A read-only HTTP API over the database.
+
+Several clients can read at the same time: queries run in threads, on a pool of
+read-only connections. Responses have an ETag, so clients can revalidate them
+with If-None-Match, and are cached until the database changes. Lists of books
+are paginated with offset and limit.
+
+    book_tools serve -d database.db --port 8080
+    curl 'http://127.0.0.1:8080/books?tag=fantasy&present_in=Libraries+West&limit=50'
+
+Endpoints:
+
+    GET /books                  books, filtered by read, tag, present_in,
+                                in_library, shop, min_price, max_price,
+                                challenge and search, and sorted by sort and desc
+    GET /books/{id}             one book, with its price history in each shop
+    GET /search?q=              books whose title, authors or tags contain the
+                                words, or words starting with them, best match
+                                first
+    GET /tags                   each tag, and the number of books with it
+    GET /libraries, /shops      the libraries and shops
+    GET /shops/{name}/prices    a summary of the price history of each book in
+                                a shop, optionally below a price
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, List, Optional, Tuple, TypeVar
+
+from aiohttp import web
+
+from database import Book, BookFilter, Database, NotFound, Shop
+import query_profiler
+from query import column_names
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+T = TypeVar("T")
+
+
+class DatabasePool:
+    """A fixed number of read-only connections, shared by the request handlers."""
+
+    def __init__(self, path: str, size: int = 4):
+        self.path = path
+        self._databases: asyncio.Queue = asyncio.Queue()
+        for _ in range(size):
+            self._databases.put_nowait(Database(path, read_only=True))
+
+    async def run(self, function: Callable[[Database], T]) -> T:
+        """Call function with a connection from the pool, in a thread, so the
+        event loop isn't blocked by the query."""
+        database = await self._databases.get()
+        try:
+            return await asyncio.to_thread(function, database)
+        finally:
+            self._databases.put_nowait(database)
+
+    def version(self) -> Tuple:
+        """A value that changes whenever the database is written to."""
+        stats = []
+        for suffix in ("", "-wal"):
+            try:
+                stat = os.stat(self.path + suffix)
+            except FileNotFoundError:
+                continue
+            stats.append((stat.st_mtime_ns, stat.st_size))
+
+        return tuple(stats)
+
+
+class ResponseCache:
+    """Keeps the most recent response bodies, and their ETags, until the
+    database changes."""
+
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Tuple[Tuple, str, bytes]]" = OrderedDict()
+
+    def get(self, key: str, version: Tuple) -> Optional[Tuple[str, bytes]]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != version:
+            return None
+
+        self._entries.move_to_end(key)
+        return entry[1], entry[2]
+
+    def put(self, key: str, version: Tuple, body: bytes) -> str:
+        etag = f'"{hashlib.sha1(body).hexdigest()[:20]}"'
+        self._entries[key] = (version, etag, body)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+        return etag
+
+
+def etag_matches(request: web.Request, etag: str) -> bool:
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is None:
+        return False
+
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+def split_names(names: Optional[str]) -> List[str]:
+    return names.split(", ") if names else []
+
+
+def book_to_json(columns: List[str], num_libraries: int, row: tuple) -> dict:
+    book_id, title, read, tags, challenges, authors, *availability = row
+    libraries = columns[6:6 + num_libraries]
+    shops = columns[6 + num_libraries:]
+
+    return {
+        "id": book_id,
+        "title": title,
+        "read": bool(read),
+        "tags": split_names(tags),
+        "challenges": split_names(challenges),
+        "authors": split_names(authors),
+        "libraries": {
+            name: None if present is None else bool(present)
+            for name, present in zip(libraries, availability[:num_libraries])
+        },
+        "prices": dict(zip(shops, availability[num_libraries:])),
+    }
+
+
+def fetch_books(database: Database, book_filter: BookFilter, **options) -> Tuple[List[str], int, List[tuple]]:
+    """Get the column names, number of libraries, and rows from iter_book_rows.
+
+    :param options: Passed to iter_book_rows, e.g. order_by.
+    """
+    libraries = database.get_libraries()
+    shops = database.get_shops()
+    rows = [
+        row
+        for batch in database.iter_book_rows(libraries, shops, book_filter=book_filter, **options)
+        for row in batch
+    ]
+    return column_names(libraries, shops), len(libraries), rows
+
+
+def query_float(request: web.Request, name: str) -> Optional[float]:
+    value = request.query.get(name)
+    if value is None:
+        return None
+
+    try:
+        return float(value)
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"{name} must be a number")
+
+
+def query_int(request: web.Request, name: str, default: int) -> int:
+    try:
+        return int(request.query.get(name, default))
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"{name} must be an integer")
+
+
+def query_bool(request: web.Request, name: str) -> Optional[bool]:
+    value = request.query.get(name)
+    if value is None:
+        return None
+    if value.lower() in ("1", "true", "yes"):
+        return True
+    if value.lower() in ("0", "false", "no"):
+        return False
+
+    raise web.HTTPBadRequest(text=f"{name} must be true or false")
+
+
+class BookApi:
+    def __init__(self, pool: DatabasePool, cache: ResponseCache):
+        self.pool = pool
+        self.cache = cache
+
+    def routes(self) -> List[web.RouteDef]:
+        return [
+            web.get("/books", self.cached(self.books)),
+            web.get("/books/{id}", self.cached(self.book)),
+            web.get("/search", self.cached(self.search)),
+            web.get("/tags", self.cached(self.tags)),
+            web.get("/libraries", self.cached(self.libraries)),
+            web.get("/shops", self.cached(self.shops)),
+            web.get("/shops/{name}/prices", self.cached(self.prices)),
+        ]
+
+    def cached(self, handler: Callable[[web.Request], Awaitable[Any]]):
+        """Serialise the handler's result as JSON, with an ETag. The body is
+        reused until the database changes."""
+        async def handle(request: web.Request) -> web.Response:
+            key = request.path_qs
+            version = self.pool.version()
+
+            entry = self.cache.get(key, version)
+            if entry is None:
+                body = json.dumps(await handler(request)).encode()
+                etag = self.cache.put(key, version, body)
+            else:
+                etag, body = entry
+
+            headers = {"ETag": etag, "Cache-Control": "no-cache"}
+            if etag_matches(request, etag):
+                return web.Response(status=304, headers=headers)
+
+            return web.Response(body=body, content_type="application/json", headers=headers)
+
+        return handle
+
+    async def books(self, request: web.Request) -> dict:
+        offset = max(query_int(request, "offset", 0), 0)
+        limit = min(max(query_int(request, "limit", DEFAULT_LIMIT), 1), MAX_LIMIT)
+
+        book_filter = BookFilter(
+            read=query_bool(request, "read"),
+            tags=request.query.getall("tag", []),
+            present_in=request.query.getall("present_in", []),
+            in_library=query_bool(request, "in_library"),
+            shop=request.query.get("shop"),
+            min_price=query_float(request, "min_price"),
+            max_price=query_float(request, "max_price"),
+            challenge=request.query.get("challenge"),
+            search=request.query.get("search"),
+        )
+        sort = request.query.get("sort")
+        descending = query_bool(request, "desc") or False
+
+        def get_books(database: Database):
+            order_by = None
+            if sort is not None:
+                columns = column_names(database.get_libraries(), database.get_shops())
+                if sort not in columns:
+                    raise web.HTTPBadRequest(text=f"unknown sort column {sort!r}")
+                order_by = columns.index(sort)
+
+            # get one more than the limit, to find out if there's another page
+            return fetch_books(
+                database,
+                book_filter,
+                batch_size=limit + 1,
+                order_by=order_by,
+                descending=descending,
+                limit=limit + 1,
+                offset=offset,
+            )
+
+        columns, num_libraries, rows = await self.pool.run(get_books)
+
+        next_url = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_url = str(request.rel_url.update_query(offset=offset + limit))
+
+        return {
+            "books": [book_to_json(columns, num_libraries, row) for row in rows],
+            "offset": offset,
+            "limit": limit,
+            "next": next_url,
+        }
+
+    async def book(self, request: web.Request) -> dict:
+        try:
+            book_id = int(request.match_info["id"])
+        except ValueError:
+            raise web.HTTPNotFound()
+
+        def get_book(database: Database):
+            columns, num_libraries, rows = fetch_books(database, BookFilter(ids=[book_id]))
+            if not rows:
+                return None
+
+            book = Book(id=book_id)
+            database.get_book(book)
+            price_history = {
+                shop.name: [
+                    {"price": price, "shipping": shipping, "observed_at": observed_at}
+                    for price, shipping, observed_at in database.get_price_history(shop, book)
+                ]
+                for shop in database.get_shops()
+            }
+
+            result = book_to_json(columns, num_libraries, rows[0])
+            result["isbn"] = book.isbn
+            result["price_history"] = price_history
+            return result
+
+        result = await self.pool.run(get_book)
+        if result is None:
+            raise web.HTTPNotFound()
+
+        return result
+
+    async def search(self, request: web.Request) -> dict:
+        text = request.query.get("q")
+        if text is None:
+            raise web.HTTPBadRequest(text="q is required")
+        limit = min(max(query_int(request, "limit", 20), 1), MAX_LIMIT)
+
+        def search_books(database: Database):
+            book_ids = database.search(text, limit)
+            columns, num_libraries, rows = fetch_books(database, BookFilter(ids=book_ids))
+
+            # put the rows in the order of the search results
+            rank = {book_id: i for i, book_id in enumerate(book_ids)}
+            rows.sort(key=lambda row: rank[row[0]])
+            return columns, num_libraries, rows
+
+        columns, num_libraries, rows = await self.pool.run(search_books)
+        return {"books": [book_to_json(columns, num_libraries, row) for row in rows]}
+
+    async def tags(self, request: web.Request) -> List[dict]:
+        tags = await self.pool.run(lambda database: database.get_tag_counts())
+        return [{"name": name, "count": count} for name, count in tags]
+
+    async def libraries(self, request: web.Request) -> List[dict]:
+        libraries = await self.pool.run(lambda database: database.get_libraries())
+        return [{"id": library.id, "name": library.name} for library in libraries]
+
+    async def shops(self, request: web.Request) -> List[dict]:
+        shops = await self.pool.run(lambda database: database.get_shops())
+        return [{"id": shop.id, "name": shop.name} for shop in shops]
+
+    async def prices(self, request: web.Request) -> List[dict]:
+        shop = Shop(request.match_info["name"])
+        below = query_float(request, "below")
+
+        try:
+            summaries = await self.pool.run(lambda database: database.get_price_summaries(shop, below))
+        except NotFound:
+            raise web.HTTPNotFound()
+
+        return [summary._asdict() for summary in summaries]
+
+
+def create_app(path: str, pool_size: int = 4) -> web.Application:
+    api = BookApi(DatabasePool(path, pool_size), ResponseCache())
+
+    app = web.Application()
+    app.add_routes(api.routes())
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="serve",
+        description="Serve a read-only HTTP API over the database.",
+    )
+    parser.add_argument(
+        "-d",
+        "--database",
+        type=str,
+        default=os.path.join(os.path.dirname(__file__), "database.db"),
+        help="Path to database to serve.",
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument("-p", "--port", type=int, default=8080, help="Port to listen on.")
+    parser.add_argument(
+        "-n",
+        "--pool-size",
+        type=int,
+        default=4,
+        help="Number of database connections, and so the number of concurrent queries.",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print a summary of the database queries made on exit.",
+    )
+
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        query_profiler.enable()
+
+    if not os.path.exists(args.database):
+        parser.error(f"{args.database} doesn't exist")
+
+    # migrate the database, since the read-only connections can't
+    Database(args.database)
+
+    web.run_app(create_app(args.database, args.pool_size), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+"""Benchmarks for the hot paths: importing, loading books, the viewer's table,
+the checkers (against a local replay server) and title matching.
+
+See benchmarks/run.py for usage.
+"""
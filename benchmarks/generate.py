@@ -0,0 +1,192 @@
+"""Generate synthetic databases for benchmarking.
+
+Word, author and tag choices follow a Zipf-like distribution, so a few authors
+and tags are very common and most are rare, as in a real catalogue.
+"""
+import argparse
+import os
+import random
+import sqlite3
+from itertools import accumulate
+from typing import List
+
+from database import Database
+
+WORDS = [
+    "the", "of", "night", "house", "war", "shadow", "river", "king", "last", "city",
+    "girl", "man", "time", "dark", "world", "little", "secret", "life", "star", "blood",
+    "garden", "winter", "fire", "stone", "sea", "glass", "song", "empire", "island", "dream",
+    "silent", "golden", "broken", "lost", "hidden", "wild", "iron", "paper", "summer", "mountain",
+    "forest", "crown", "ghost", "machine", "letter", "wolf", "bridge", "tower", "storm", "memory",
+]
+
+FIRST_NAMES = [
+    "Anne", "James", "Mary", "John", "Ursula", "Terry", "Iain", "Octavia", "Neil", "Jane",
+    "Kazuo", "Margaret", "George", "Toni", "Philip", "Zadie", "Haruki", "Ann", "Ray", "Emily",
+]
+
+LAST_NAMES = [
+    "Smith", "Le Guin", "Pratchett", "Banks", "Butler", "Gaiman", "Austen", "Ishiguro",
+    "Atwood", "Eliot", "Morrison", "Dick", "Bradbury", "Bronte", "Leckie", "Jemisin",
+    "Murakami", "Mantel", "Tolkien", "Shelley",
+]
+
+LIBRARIES = ["Nottingham City Libraries", "Libraries West", "Nottingham University"]
+SHOPS = ["Abe Books"]
+
+
+class ZipfChoice:
+    """Picks items with probability proportional to 1 / rank."""
+
+    def __init__(self, items: List, rng: random.Random):
+        self.items = items
+        self.rng = rng
+        self.cumulative_weights = list(accumulate(1 / rank for rank in range(1, len(items) + 1)))
+
+    def __call__(self, k: int = 1) -> List:
+        return self.rng.choices(self.items, cum_weights=self.cumulative_weights, k=k)
+
+
+def with_check_digit(isbn: str) -> str:
+    """Add the check digit to the first 12 digits of an ISBN-13."""
+    total = sum(int(c) * (3 if i % 2 else 1) for i, c in enumerate(isbn))
+    return isbn + str(-total % 10)
+
+
+def generate_database(
+    path: str,
+    num_books: int,
+    num_tags: int = 200,
+    num_challenges: int = 5,
+    seed: int = 0,
+):
+    """Create a database at path, filled with synthetic books."""
+    if os.path.exists(path):
+        os.remove(path)
+
+    # create the schema
+    Database(path)
+
+    rng = random.Random(seed)
+    connection = sqlite3.connect(path)
+    cursor = connection.cursor()
+
+    # authors
+    num_authors = max(1, num_books // 3)
+    authors = [
+        (i + 1, f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {i}")
+        for i in range(num_authors)
+    ]
+    cursor.executemany("INSERT INTO Author (id, name) VALUES (?, ?)", authors)
+    choose_author = ZipfChoice([id_ for id_, _ in authors], rng)
+
+    # books
+    choose_word = ZipfChoice(WORDS, rng)
+    books = []
+    book_authors = []
+    for book_id in range(1, num_books + 1):
+        title = " ".join(choose_word(rng.randint(1, 5))).capitalize() + f" {book_id}"
+        isbn = with_check_digit(f"978{rng.randrange(10 ** 9):09d}") if rng.random() < 0.8 else None
+        read = rng.random() < 0.3
+        books.append((book_id, isbn, title, read, rng.random() < 0.5))
+
+        num_book_authors = rng.choices([1, 2, 3], weights=[85, 12, 3])[0]
+        for author_id in set(choose_author(num_book_authors)):
+            book_authors.append((book_id, author_id))
+
+    cursor.executemany(
+        "INSERT INTO Book (id, isbn, title, read, tags_searched) VALUES (?, ?, ?, ?, ?)",
+        books,
+    )
+    cursor.executemany("INSERT INTO BookAuthor (book, author) VALUES (?, ?)", book_authors)
+
+    # tags
+    tags = [(i + 1, f"tag {i}") for i in range(num_tags)]
+    cursor.executemany("INSERT INTO Tag (id, name) VALUES (?, ?)", tags)
+    choose_tag = ZipfChoice([id_ for id_, _ in tags], rng)
+    cursor.executemany(
+        "INSERT INTO BookTag (book, tag) VALUES (?, ?)",
+        (
+            (book_id, tag_id)
+            for book_id in range(1, num_books + 1)
+            for tag_id in set(choose_tag(rng.randint(0, 8)))
+        ),
+    )
+
+    # libraries: most books have been checked, and some are present
+    cursor.executemany("INSERT INTO LibrarySystem (name) VALUES (?)", ((name,) for name in LIBRARIES))
+    cursor.executemany(
+        "INSERT INTO LibraryBook (library, book, present) VALUES (?, ?, ?)",
+        (
+            (library_id, book_id, rng.random() < 0.4)
+            for library_id in range(1, len(LIBRARIES) + 1)
+            for book_id in range(1, num_books + 1)
+            if rng.random() < 0.7
+        ),
+    )
+
+    # shops: prices are roughly log-normal
+    cursor.executemany("INSERT INTO Shop (name) VALUES (?)", ((name,) for name in SHOPS))
+    shop_books = []
+    for shop_id in range(1, len(SHOPS) + 1):
+        for book_id in range(1, num_books + 1):
+            if rng.random() > 0.7:
+                continue
+            present = rng.random() < 0.9
+            price = round(rng.lognormvariate(1.8, 0.6), 2) if present else None
+            shop_books.append((shop_id, book_id, present, price))
+    cursor.executemany(
+        "INSERT INTO ShopBook (shop, book, present, price) VALUES (?, ?, ?, ?)",
+        shop_books,
+    )
+
+    # challenges
+    cursor.executemany(
+        "INSERT INTO Challenge (name) VALUES (?)",
+        ((f"Challenge {i}",) for i in range(num_challenges)),
+    )
+    for challenge_id in range(1, num_challenges + 1):
+        size = min(num_books, rng.randint(50, 500))
+        cursor.executemany(
+            "INSERT INTO ChallengeBook (challenge, book) VALUES (?, ?)",
+            ((challenge_id, book_id) for book_id in rng.sample(range(1, num_books + 1), size)),
+        )
+
+    connection.commit()
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        "generate",
+        description="Generate a synthetic database for benchmarking.",
+    )
+    parser.add_argument(
+        "-d",
+        "--database",
+        type=str,
+        default="benchmark.db",
+        help="Path to the database to create. It is overwritten if it exists.",
+    )
+    parser.add_argument(
+        "-n",
+        "--num-books",
+        type=int,
+        default=10000,
+        help="Number of books to generate.",
+    )
+    parser.add_argument(
+        "-s",
+        "--seed",
+        type=int,
+        default=0,
+        help="Random seed.",
+    )
+
+    args = parser.parse_args()
+
+    generate_database(args.database, args.num_books, seed=args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Local server replaying the HTML fixtures in place of the real sites.
+
+Each fixture is a template, with $title replaced by the search term, so the
+scrapers' title matching finds the book being searched for.
+"""
+import argparse
+import asyncio
+import html
+import os
+from string import Template
+from typing import Dict
+
+from aiohttp import web
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+# maps each route to the fixture it serves, and the query parameter holding the search term
+ROUTES = {
+    "/abebooks/servlet/SearchResults": ("abebooks_search.html", "kn"),
+    "/librarieswest/search": ("arena_search.html", "p_r_p_arena_urn:arena_search_query"),
+    "/nottingham/search": ("arena_search.html", "p_r_p_arena_urn:arena_search_query"),
+    "/storygraph/browse": ("storygraph_browse.html", "search_term"),
+    "/nusearch/primo-explore/search": ("primo_search.html", "query"),
+}
+
+
+def load_fixtures() -> Dict[str, Template]:
+    fixtures = {}
+    for file_name, _ in ROUTES.values():
+        with open(os.path.join(FIXTURES_DIR, file_name)) as f:
+            fixtures[file_name] = Template(f.read())
+
+    return fixtures
+
+
+def create_app(latency: float = 0.0) -> web.Application:
+    """Create the replay application.
+
+    :param latency: Seconds to wait before each response, to simulate the network.
+    """
+    fixtures = load_fixtures()
+
+    def handler(file_name: str, param: str):
+        async def handle(request: web.Request) -> web.Response:
+            if latency:
+                await asyncio.sleep(latency)
+
+            title = request.query.get(param, "")
+            if param == "query":
+                # primo queries look like "any,contains,<title>"
+                title = title.split(",", 2)[-1]
+
+            body = fixtures[file_name].safe_substitute(title=html.escape(title))
+            return web.Response(text=body, content_type="text/html")
+
+        return handle
+
+    app = web.Application()
+    for path, (file_name, param) in ROUTES.items():
+        app.router.add_get(path, handler(file_name, param))
+
+    return app
+
+
+async def start_server(port: int = 0, latency: float = 0.0):
+    """Start the server in the running event loop.
+
+    :return: The runner, which must be cleaned up, and the server's base URL.
+    """
+    runner = web.AppRunner(create_app(latency))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        "replay_server",
+        description="Serve the scraper fixtures locally.",
+    )
+    parser.add_argument("-p", "--port", type=int, default=8080)
+    parser.add_argument(
+        "-l",
+        "--latency",
+        type=float,
+        default=0.0,
+        help="Seconds to wait before each response.",
+    )
+
+    args = parser.parse_args()
+
+    web.run_app(create_app(args.latency), host="127.0.0.1", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
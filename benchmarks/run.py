@@ -0,0 +1,332 @@
+"""Run the benchmarks, and save the results as JSON.
+
+Run from the repository root:
+
+    python -m benchmarks.run -n 10000 -o results.json
+    python -m benchmarks.run -n 10000 -o new.json --compare results.json
+
+The scrapers are run end-to-end against the local replay server, so the
+results don't depend on the real sites.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from statistics import mean
+from typing import Callable, Dict, List, Optional
+
+from benchmarks.generate import generate_database
+from database import Author, Book, Database
+
+# maps the name of each benchmark to its setup function. The setup function is
+# called before each repeat, and returns the function to time.
+BENCHMARKS: Dict[str, Callable[["Context"], Callable[[], None]]] = {}
+
+
+class SkipBenchmark(Exception):
+    pass
+
+
+class Context:
+    def __init__(self, database: str, work_dir: str, num_books: int, num_checked: int, selenium: bool):
+        self.database = database
+        self.work_dir = work_dir
+        self.num_books = num_books
+        self.num_checked = num_checked
+        self.selenium = selenium
+        self.server_url: Optional[str] = None
+
+    def copy_database(self) -> str:
+        path = os.path.join(self.work_dir, "copy.db")
+        shutil.copyfile(self.database, path)
+        return path
+
+
+def benchmark(name: str):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return register
+
+
+@benchmark("import")
+def bench_import(context: Context):
+    path = os.path.join(context.work_dir, "import.db")
+    if os.path.exists(path):
+        os.remove(path)
+    database = Database(path)
+
+    num_books = min(context.num_books, 1000)
+    books = [
+        Book(f"978{i:010d}", f"Imported book {i}", read=i % 3 == 0, authors=[Author(f"Author {i % 50}")])
+        for i in range(num_books)
+    ]
+
+    def run():
+        # the same calls as load_storygraph
+        database.resolve_authors(author for book in books for author in book.authors)
+        for book in books:
+            if database.get_book(book):
+                database.update_book(book)
+            else:
+                database.add_book(book)
+            database.add_book_tags(book, ["tag a", "tag b", f"tag {book.id % 20}"])
+
+    return run
+
+
+@benchmark("get_books")
+def bench_get_books(context: Context):
+    database = Database(context.database)
+    return database.get_books
+
+
+@benchmark("get_book_rows")
+def bench_get_book_rows(context: Context):
+    database = Database(context.database)
+    return database.get_book_rows
+
+
+@benchmark("viewer_rows")
+def bench_viewer_rows(context: Context):
+    database = Database(context.database)
+
+    def run():
+        libraries = database.get_libraries()
+        shops = database.get_shops()
+        for _ in database.iter_book_rows(libraries, shops):
+            pass
+
+    return run
+
+
+@benchmark("viewer_create_table")
+def bench_viewer_create_table(context: Context):
+    try:
+        import viewer
+    except ImportError as e:
+        raise SkipBenchmark(str(e))
+
+    database = Database(context.database)
+    return lambda: viewer.create_table(database)
+
+
+@benchmark("check_titles")
+def bench_check_titles(context: Context):
+    from check_libraries.common import check_titles
+
+    database = Database(context.database)
+    titles = [book.title for book in database.get_book_rows()][:context.num_checked * 10]
+
+    def run():
+        for title_1, title_2 in zip(titles, reversed(titles)):
+            check_titles(title_1, title_2)
+
+    return run
+
+
+def checker_benchmark(name: str, module_name: str, route: str):
+    """Register a benchmark running an aiohttp checker against the replay server."""
+    @benchmark(name)
+    def setup(context: Context):
+        import importlib
+
+        import aiohttp
+
+        from http_client import CoalescingSearch
+
+        module = importlib.import_module(module_name)
+        module.SEARCH_URL = context.server_url + route
+        # start each repeat without remembered search results
+        module.searches = CoalescingSearch(module.HOST)
+
+        from db_writer import DatabaseWriter
+
+        path = context.copy_database()
+        database = Database(path)
+        books = database.get_books()[:context.num_checked]
+
+        async def check():
+            connector = aiohttp.TCPConnector(limit=10)
+            async with aiohttp.ClientSession(connector=connector) as session:
+                if module_name == "get_tags":
+                    await module.harvest_tags(books, database, session)
+                else:
+                    async with DatabaseWriter(path) as writer:
+                        await asyncio.gather(*(
+                            module.process_book(book, writer, session) for book in books
+                        ))
+
+        def run():
+            with contextlib.redirect_stdout(open(os.devnull, "w")):
+                asyncio.run(check())
+
+        return run
+
+
+checker_benchmark("check_abebooks", "check_libraries.check_abebooks", "/abebooks/servlet/SearchResults")
+checker_benchmark("check_libraries_west", "check_libraries.check_libraries_west", "/librarieswest/search")
+checker_benchmark("check_nottingham_libraries", "check_libraries.check_nottingham_libraries", "/nottingham/search")
+checker_benchmark("get_tags", "get_tags", "/storygraph/browse")
+
+
+@benchmark("check_nottingham_university")
+def bench_check_nottingham_university(context: Context):
+    if not context.selenium:
+        raise SkipBenchmark("pass --selenium to run")
+
+    from configparser import ConfigParser
+    from threading import current_thread
+
+    from selenium import webdriver
+    from selenium.webdriver.firefox.options import Options
+
+    from check_libraries import check_nottingham_university
+
+    check_nottingham_university.SEARCH_URL = context.server_url + "/nusearch/primo-explore/search"
+
+    config_parser = ConfigParser()
+    config_parser.read("config.ini")
+    options = Options()
+    options.binary_location = config_parser.get("firefox", "executable")
+    options.add_argument("--headless")
+    driver = webdriver.Firefox(options=options)
+    check_nottingham_university.webdrivers[current_thread().name] = driver
+
+    path = context.copy_database()
+    books = Database(path).get_books()[:context.num_checked]
+
+    def run():
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            for book in books:
+                check_nottingham_university.process_book(book, path)
+
+    return run
+
+
+def start_replay_server(latency: float) -> str:
+    """Run the replay server in a background thread, returning its base URL."""
+    from benchmarks.replay_server import start_server
+
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    result = {}
+
+    def serve():
+        asyncio.set_event_loop(loop)
+        _, result["url"] = loop.run_until_complete(start_server(latency=latency))
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=serve, daemon=True).start()
+    started.wait()
+
+    return result["url"]
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline_path: str, threshold: float = 0.1):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    print(f"\ncompared with {baseline.get('commit')}:")
+    for name, result in results["benchmarks"].items():
+        if name not in baseline["benchmarks"]:
+            continue
+
+        ratio = result["min"] / baseline["benchmarks"][name]["min"]
+        flag = "  REGRESSION" if ratio > 1 + threshold else ""
+        print(f"{name:<30} {ratio:>6.2f}x{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        "benchmarks",
+        description="Run the benchmarks.",
+    )
+    parser.add_argument("-n", "--num-books", type=int, default=10000, help="Number of books in the database.")
+    parser.add_argument(
+        "-c",
+        "--num-checked",
+        type=int,
+        default=200,
+        help="Number of books searched for by each checker.",
+    )
+    parser.add_argument("-r", "--repeats", type=int, default=3, help="Number of times to run each benchmark.")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="Random seed for the generated database.")
+    parser.add_argument(
+        "-l",
+        "--latency",
+        type=float,
+        default=0.0,
+        help="Seconds the replay server waits before each response.",
+    )
+    parser.add_argument("-o", "--output", type=str, help="Write the results to this JSON file.")
+    parser.add_argument("--compare", type=str, help="Compare the results with a previous JSON file.")
+    parser.add_argument("--selenium", action="store_true", help="Also run the selenium checker.")
+    parser.add_argument("benchmarks", nargs="*", help="Benchmarks to run. All are run by default.")
+
+    args = parser.parse_args()
+
+    names: List[str] = args.benchmarks or list(BENCHMARKS)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        database = os.path.join(work_dir, "benchmark.db")
+        generate_database(database, args.num_books, seed=args.seed)
+
+        context = Context(database, work_dir, args.num_books, args.num_checked, args.selenium)
+        try:
+            context.server_url = start_replay_server(args.latency)
+        except ImportError:
+            print("aiohttp isn't installed, so the checkers can't be benchmarked.", file=sys.stderr)
+
+        results = {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "num_books": args.num_books,
+            "num_checked": args.num_checked,
+            "benchmarks": {},
+        }
+
+        for name in names:
+            times = []
+            try:
+                for _ in range(args.repeats):
+                    run = BENCHMARKS[name](context)
+                    start = time.perf_counter()
+                    run()
+                    times.append(time.perf_counter() - start)
+            except (SkipBenchmark, ImportError) as e:
+                print(f"{name:<30} skipped: {e}")
+                continue
+
+            results["benchmarks"][name] = {"min": min(times), "mean": mean(times), "times": times}
+            print(f"{name:<30} min {min(times):>9.4f}s  mean {mean(times):>9.4f}s")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
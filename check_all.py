@@ -0,0 +1,208 @@
+"""Check every library and shop in one concurrent pass.
+
+The books are loaded once, and every source is searched at the same time, with
+a shared HTTP session and a concurrency limit for each source. All results are
+written to the database in batches by a single writer thread, so the total time
+is close to that of the slowest source.
+"""
+import argparse
+import asyncio
+import importlib
+import os
+from typing import TYPE_CHECKING, Dict, List
+
+import query_profiler
+from database import Book, Database
+from db_writer import DatabaseWriter
+from telemetry import metrics
+
+if TYPE_CHECKING:
+    import aiohttp
+
+# maps the name of each aiohttp source to its module, and the default number of
+# concurrent searches. The modules are only imported if the source is checked.
+ASYNC_SOURCES = {
+    "abebooks": ("check_libraries.check_abebooks", 10),
+    "libraries_west": ("check_libraries.check_libraries_west", 10),
+    "nottingham_libraries": ("check_libraries.check_nottingham_libraries", 10),
+}
+SELENIUM_SOURCES = {
+    "nottingham_university": "check_libraries.check_nottingham_university",
+}
+
+
+def import_source(name: str):
+    if name in ASYNC_SOURCES:
+        return importlib.import_module(ASYNC_SOURCES[name][0])
+    return importlib.import_module(SELENIUM_SOURCES[name])
+
+
+async def check_async_source(
+    module,
+    books: List[Book],
+    writer: DatabaseWriter,
+    session: "aiohttp.ClientSession",
+    concurrency: int,
+):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def process_book(book: Book):
+        async with semaphore:
+            await module.process_book(book, writer, session)
+
+    await asyncio.gather(*(process_book(book) for book in books))
+
+
+async def check_university(books: List[Book], writer: DatabaseWriter, num_workers: int):
+    module = import_source("nottingham_university")
+    config_path = os.path.join(os.path.dirname(__file__), "config.ini")
+
+    def process_book(book: Book):
+        url, present = module.search_book(book)
+        writer.put_threadsafe("add_library_book", module.library, book, present)
+        print(book.title, url)
+        metrics.book_done()
+
+    def check_books():
+        pool = module.create_pool(num_workers, config_path)
+        try:
+            pool.map(process_book, books)
+        finally:
+            module.close_pool(pool)
+
+    await asyncio.to_thread(check_books)
+
+
+async def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="check_all",
+        description="Check which books are available in every library and shop.",
+    )
+    parser.add_argument(
+        "-d",
+        "--database",
+        type=str,
+        default=os.path.join(os.path.dirname(__file__), "database.db"),
+        help="Path to database containing books to check.",
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Search for all books, even if they have been searched before.",
+    )
+    parser.add_argument(
+        "-s",
+        "--sources",
+        nargs="+",
+        choices=list(ASYNC_SOURCES) + list(SELENIUM_SOURCES),
+        default=list(ASYNC_SOURCES) + list(SELENIUM_SOURCES),
+        help="Sources to check. All are checked by default.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        nargs="+",
+        default=[],
+        metavar="SOURCE=N",
+        help="Maximum number of concurrent searches for a source.",
+    )
+    parser.add_argument(
+        "-n",
+        "--num-workers",
+        type=int,
+        default=5,
+        help="Number of selenium threads to use.",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        type=int,
+        default=100,
+        help="Maximum number of results to write in each transaction.",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        help="Write request metrics to this file, as JSON lines, or Prometheus text if it ends in .prom.",
+    )
+    parser.add_argument(
+        "--progress",
+        action="store_true",
+        help="Show a progress line on stderr.",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print a summary of the database queries made on exit.",
+    )
+
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        query_profiler.enable()
+
+    concurrency = {name: default for name, (_, default) in ASYNC_SOURCES.items()}
+    for item in args.concurrency:
+        name, value = item.split("=")
+        concurrency[name] = int(value)
+
+    database = Database(args.database)
+    books = database.get_books()
+
+    # work out which books need checking in each source
+    work: Dict[str, List[Book]] = {}
+    for name in args.sources:
+        module = import_source(name)
+
+        if hasattr(module, "shop"):
+            database.add_shop(module.shop)
+            database.get_item(module.shop)
+            checked = database.get_checked_shop_book_ids(module.shop)
+        else:
+            database.add_library_system(module.library)
+            database.get_item(module.library)
+            checked = database.get_checked_library_book_ids(module.library)
+
+        if args.force:
+            work[name] = books
+        else:
+            work[name] = [book for book in books if book.id not in checked]
+
+            if hasattr(module, "searches"):
+                # reuse the results of recent searches
+                module.searches.memo.update(
+                    database.get_search_results(module.HOST, module.MAX_SEARCH_AGE_DAYS)
+                )
+
+    if args.progress:
+        metrics.start_progress(sum(len(books) for books in work.values()))
+
+    import aiohttp
+
+    # the concurrency of each source is limited by its semaphore, not the connector
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(
+        connector=connector, trace_configs=[metrics.trace_config()]
+    ) as session:
+        async with DatabaseWriter(args.database, args.batch_size) as writer:
+            tasks = []
+            for name, source_books in work.items():
+                if name in ASYNC_SOURCES:
+                    module = import_source(name)
+                    tasks.append(check_async_source(module, source_books, writer, session, concurrency[name]))
+                elif source_books:
+                    tasks.append(check_university(source_books, writer, args.num_workers))
+
+            await asyncio.gather(*tasks)
+
+    for name in work:
+        if name in ASYNC_SOURCES:
+            module = import_source(name)
+            database.add_search_results(module.HOST, module.searches.new_results)
+
+    if args.metrics:
+        metrics.write(args.metrics)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
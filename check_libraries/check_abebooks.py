@@ -2,47 +2,123 @@ import argparse
 import asyncio
 import os
 import re
-from typing import Optional, Tuple
+from typing import List, NamedTuple, Optional
 
 import aiohttp
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from yarl import URL
 
-from check_libraries.common import check_titles
+from check_libraries.common import (
+    check_author,
+    check_titles,
+    normalise_isbn,
+    normalise_search_term,
+    record_lookup,
+)
 from database import Book, Database, Shop
+from db_writer import DatabaseWriter
+from http_client import CoalescingSearch, FetchFailed, fetch
+import query_profiler
+from telemetry import metrics
 
 shop = Shop("Abe Books")
+HOST = "www.abebooks.co.uk"
+SEARCH_URL = "https://www.abebooks.co.uk/servlet/SearchResults"
+searches = CoalescingSearch(HOST)
+# prices change, so searches older than this are made again
+MAX_SEARCH_AGE_DAYS = 7
+
+
+class Offer(NamedTuple):
+    # including shipping
+    price: float
+    shipping: Optional[float]
+    link: Optional[str]
+    title: Optional[str] = None
+    author: Optional[str] = None
+
+
+class Result(NamedTuple):
+    """The cheapest offer of a book. url is None if it wasn't found."""
+    url: Optional[URL]
+    price: Optional[float]
+    shipping: Optional[float]
+    offer_count: Optional[int]
+    # whether the result is from a search made in an earlier run, so the price
+    # wasn't seen now
+    remembered: bool = False
+
+
+NOT_FOUND = Result(None, None, None, 0)
 
 
 async def process_book(
     book: Book,
-    database: Database,
+    writer: DatabaseWriter,
     session: aiohttp.ClientSession,
+    max_offers: Optional[int] = None,
 ) -> Optional[URL]:
-    url, price = await get_book(book, session)
-    database.add_book_in_shop(shop, book, url is not None, price)
-    print(book.title, url, price)
-    return url
+    try:
+        result = await get_book(book, session, max_offers)
+        present = result.url is not None
+    except FetchFailed as e:
+        # record the result as unknown, so the book is searched again next time
+        result = Result(None, None, None, None)
+        present = None
+        print(book.title, "failed:", e)
+
+    # remembered prices are already in the price history
+    await writer.add_book_in_shop(
+        shop,
+        book,
+        present,
+        result.price,
+        result.shipping,
+        result.offer_count,
+        observed=not result.remembered,
+    )
+    print(book.title, result.url, result.price)
+    metrics.book_done()
+    return result.url
 
 
 async def get_book(
     book: Book,
     session: aiohttp.ClientSession,
-) -> Tuple[Optional[URL], Optional[float]]:
-    """Search AbeBooks for the book
+    max_offers: Optional[int] = None,
+) -> Result:
+    """Search AbeBooks for the cheapest offer of the book, by ISBN if it's
+    known, then by title
 
+    :param max_offers: Only compare the first max_offers results on each
+    page. None compares them all.
     :return: If the book is found, a URL to the
-    search results or the book is returned, and
-    the price. Else, (None, None) is returned.
+    cheapest offer, its price including shipping,
+    the shipping, and the number of offers compared.
+    Else, NOT_FOUND is returned.
+    :raises FetchFailed: If the search failed.
     """
-    url = "https://www.abebooks.co.uk/servlet/SearchResults"
+    isbn = normalise_isbn(book.isbn)
+    if isbn is not None:
+        # sorted by price, lowest first
+        params = {
+            "cm_sp": "SearchF-_-Advs-_-Result",
+            "isbn": isbn,
+            "prc": "GBP",
+            "sortby": 17,
+        }
+        # the ISBN identifies the book, so the results aren't checked
+        result = await search_offers(f"isbn:{isbn}", params, "isbn", session, max_offers)
+        record_lookup(HOST, "isbn", result.url is not None)
+        if result.url is not None:
+            return result
 
-    if len(book.authors) == 0:
-        # search without author
-        search_term = book.title.lower().strip()
-        if search_term.startswith("the "):
-            search_term = search_term[4:]
+    search_term = normalise_search_term(book.title)
+    author = book.authors[0].name if book.authors else None
 
+    if author is None:
+        # search without author
+        key = search_term
         params = {
             "cm_sp": "SearchF-_-home-_-Results",
             "ds": 20,
@@ -50,14 +126,16 @@ async def get_book(
             "sts": "t",
         }
     else:
-        # search with author
+        # search with author, sorted by price, lowest first, so the cheapest
+        # offers are at the top of the page
+        key = f"{author}|{search_term}"
         params = {
-            "an": book.authors[0].name,
+            "an": author,
             "bi": 0,
             "bx": "off",
             "cm_sp": "SearchF-_-Advs-_-Result",
             "ds": 30,
-            "kn": book.title,
+            "kn": search_term,
             "prc": "GBP",
             "recentlyadded": "all",
             "rgn": "ww",
@@ -67,43 +145,137 @@ async def get_book(
             "xpod": "off",
         }
 
-    async with session.get(url=url, params=params) as response:
-        content = await response.read()
+    # keyword searches also find other books, e.g. study guides, so only
+    # compare the results with the book's title and author
+    result = await search_offers(key, params, "title", session, max_offers, book.title, author)
+    record_lookup(HOST, "title", result.url is not None)
+    return result
+
+
+async def search_offers(
+    key: str,
+    params: dict,
+    path: str,
+    session: aiohttp.ClientSession,
+    max_offers: Optional[int] = None,
+    title: Optional[str] = None,
+    author: Optional[str] = None,
+) -> Result:
+    """Search AbeBooks, and find the cheapest offer.
+
+    Searches with the same key and max_offers share the result.
+
+    :param path: "isbn" or "title", for the metrics.
+    :param max_offers: Only compare the first max_offers results.
+    :param title: If given, only compare results with this title.
+    :param author: If given, only compare results by this author.
+    :return: The same as get_book.
+    """
+    url = SEARCH_URL
+    if max_offers is not None:
+        # comparing fewer offers can find a different cheapest one
+        key = f"{key}|{max_offers} offers"
+
+    async def search():
+        response_url, content = await fetch(session, url, params)
+        metrics.increment(HOST, f"{path}_bytes", len(content))
+
+        with metrics.time(HOST, "parse"):
+            offers = parse_offers(content, max_offers, title, author)
+
+        if not offers:
+            return {"url": None, "price": None, "shipping": None, "offer_count": 0}
+
+        best = offers[0]
+        link = str(response_url.join(URL(best.link))) if best.link else str(response_url)
+        return {"url": link, "price": best.price, "shipping": best.shipping, "offer_count": len(offers)}
 
-        soup = BeautifulSoup(content, "html.parser")
+    result = await searches(key, search)
+    if result["url"] is None:
+        return NOT_FOUND
 
-        # Find the div containing the search results.
-        results_div = soup.find("div", {"class": "result-set"})
-        if results_div is None:
-            return None, None
+    return Result(
+        URL(result["url"]),
+        result["price"],
+        result["shipping"],
+        result["offer_count"],
+        remembered=not searches.is_new(key),
+    )
+
+
+def parse_offers(
+    content: bytes,
+    max_offers: Optional[int] = None,
+    title: Optional[str] = None,
+    author: Optional[str] = None,
+) -> List[Offer]:
+    """Find the offers in the search results, cheapest first.
+
+    Only the search results are parsed into a tree, in a single pass over the
+    page.
+
+    :param max_offers: Only compare the first max_offers results on the page.
+    :param title: If given, skip results with a different title.
+    :param author: If given, skip results by a different author. Results
+    without an author aren't skipped.
+    """
+    soup = BeautifulSoup(content, "html.parser", parse_only=SoupStrainer("div", {"class": "result-set"}))
+
+    offers = []
+    for book_li in soup.find_all("li", {"class": "result-item"}, limit=max_offers):
+        offer = parse_offer(book_li)
+        if offer is None:
+            continue
+        if title is not None and (offer.title is None or not check_titles(title, offer.title)):
+            continue
+        if author is not None and offer.author is not None and not check_author(author, offer.author):
+            continue
+        offers.append(offer)
 
-        # Check if the book is in the search results.
-        book_li = results_div.find("li", {"class": "result-item"})
-        if book_li is None:
-            return None, None
+    offers.sort(key=lambda offer: offer.price)
+    return offers
 
-        # Find price.
-        price_p = book_li.find("p", {"class": "item-price"})
-        if price_p is None:
-            return None, None
-        price_text = price_p.text.split("£")[-1]
-        price = float("".join(c for c in price_text if c.isnumeric() or c == "."))
 
-        # Find shipping.
-        shipping_span = book_li.find("span", {"class": "item-shipping"})
-        if shipping_span is not None:
-            shipping_text = shipping_span.text
-            match = re.match(r"£\s*(\d+(\.\d+)?)\s*Shipping", shipping_text)
-            if match is not None:
-                price += float(match.group(1))
+def parse_offer(book_li) -> Optional[Offer]:
+    """Find the price of a search result, including shipping, and its title
+    and author."""
+    # Find price.
+    price_p = book_li.find("p", {"class": "item-price"})
+    if price_p is None:
+        return None
+    price_text = price_p.text.split("£")[-1]
+    price = float("".join(c for c in price_text if c.isnumeric() or c == "."))
 
-        return response.url, price
+    # Find shipping.
+    shipping = None
+    shipping_span = book_li.find("span", {"class": "item-shipping"})
+    if shipping_span is not None:
+        shipping_text = shipping_span.text
+        match = re.match(r"£\s*(\d+(\.\d+)?)\s*Shipping", shipping_text)
+        if match is not None:
+            shipping = float(match.group(1))
+            price += shipping
+        elif "FREE" in shipping_text.upper():
+            shipping = 0.0
 
+    # Find link to the offer, and its title.
+    title_h2 = book_li.find("h2", {"class": "title"})
+    link = title_h2.find("a") if title_h2 is not None else None
+    title = title_h2.text.strip() if title_h2 is not None else None
 
-async def main():
+    # Find author. AbeBooks shows "Unknown" if the seller didn't give one.
+    author_p = book_li.find("p", {"class": "author"})
+    author = author_p.text.strip() if author_p is not None else None
+    if not author or author.lower() == "unknown":
+        author = None
+
+    return Offer(price, shipping, link.attrs.get("href") if link is not None else None, title, author)
+
+
+async def main(argv=None):
     parser = argparse.ArgumentParser(
-        prog="check_nottingham_libraries",
-        description="Check which books are available in Nottingham libraries.",
+        prog="check_abebooks",
+        description="Check which books are available on AbeBooks, and their prices.",
     )
     parser.add_argument(
         "-d",
@@ -124,8 +296,31 @@ async def main():
         action="store_true",
         help="Clear database of entries for this library before starting.",
     )
+    parser.add_argument(
+        "--offers",
+        type=int,
+        help="Number of results on each page to compare, to find the cheapest. All are compared by default.",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        help="Write request metrics to this file, as JSON lines, or Prometheus text if it ends in .prom.",
+    )
+    parser.add_argument(
+        "--progress",
+        action="store_true",
+        help="Show a progress line on stderr.",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print a summary of the database queries made on exit.",
+    )
+
+    args = parser.parse_args(argv)
 
-    args = parser.parse_args()
+    if args.profile:
+        query_profiler.enable()
 
     database = Database(args.database)
     database.add_shop(shop)
@@ -137,22 +332,34 @@ async def main():
 
     if not args.force:
         # only check books that haven't been checked yet
-        books = [
-            book
-            for book in books
-            if database.check_book_in_shop(book, shop)[0] is None
-        ]
+        checked = database.get_checked_shop_book_ids(shop)
+        books = [book for book in books if book.id not in checked]
+
+    if not args.force and not args.clear:
+        # reuse the results of recent searches
+        searches.memo.update(database.get_search_results(HOST, MAX_SEARCH_AGE_DAYS))
 
     # If you make too many requests, you get banned, so the number of threads has been limited to 10. I don't know how
     # many more it still works with.
     connector = aiohttp.TCPConnector(limit=10)
-    async with aiohttp.ClientSession(connector=connector) as session:
-        tasks = []
-        for book in books:
-            task = asyncio.ensure_future(process_book(book, database, session))
-            tasks.append(task)
+    if args.progress:
+        metrics.start_progress(len(books))
+
+    async with aiohttp.ClientSession(
+        connector=connector, trace_configs=[metrics.trace_config()]
+    ) as session:
+        async with DatabaseWriter(args.database) as writer:
+            tasks = []
+            for book in books:
+                task = asyncio.ensure_future(process_book(book, writer, session, args.offers))
+                tasks.append(task)
+
+            await asyncio.gather(*tasks)
+
+    database.add_search_results(HOST, searches.new_results)
 
-        await asyncio.gather(*tasks)
+    if args.metrics:
+        metrics.write(args.metrics)
 
 
 if __name__ == "__main__":
@@ -1,16 +1,25 @@
 import argparse
 import asyncio
 import os
-from typing import Optional
+from typing import List, Optional, Tuple
 
 import aiohttp
 from bs4 import BeautifulSoup
 from yarl import URL
 
-from check_libraries.common import check_titles
+from check_libraries.common import check_titles, normalise_isbn, normalise_search_term, record_lookup
 from database import Book, Database, LibrarySystem
+from db_writer import DatabaseWriter
+from http_client import CoalescingSearch, FetchFailed, fetch
+import query_profiler
+from telemetry import metrics
 
 library = LibrarySystem("Nottingham City Libraries")
+HOST = "catalogue.nottinghamcitylibraries.co.uk"
+SEARCH_URL = "https://catalogue.nottinghamcitylibraries.co.uk/search"
+searches = CoalescingSearch(HOST)
+# libraries add and remove books, so searches older than this are made again
+MAX_SEARCH_AGE_DAYS = 30
 
 
 # TODO: merge this script with the libraries west script. They now use the same system.
@@ -19,12 +28,21 @@ library = LibrarySystem("Nottingham City Libraries")
 
 async def process_book(
     book: Book,
-    database: Database,
+    writer: DatabaseWriter,
     session: aiohttp.ClientSession,
 ) -> Optional[URL]:
-    url = await get_book(book, session)
-    database.add_library_book(library, book, url is not None)
+    try:
+        url = await get_book(book, session)
+        present = url is not None
+    except FetchFailed as e:
+        # record the result as unknown, so the book is searched again next time
+        url = None
+        present = None
+        print(book.title, "failed:", e)
+
+    await writer.add_library_book(library, book, present)
     print(book.title, url)
+    metrics.book_done()
     return url
 
 
@@ -32,17 +50,46 @@ async def get_book(
     book: Book,
     session: aiohttp.ClientSession,
 ) -> Optional[URL]:
-    """Search Nottingham Libraries for the book
+    """Search Nottingham Libraries for the book, by ISBN if it's known, then by title
 
     :return: If the book is found, a URL to the
     search results or the book is returned. Else,
     None is returned.
+    :raises FetchFailed: If the search failed.
     """
-    search_term = book.title.lower().strip()
-    if search_term.startswith("the "):
-        search_term = search_term[4:]
+    isbn = normalise_isbn(book.isbn)
+    if isbn is not None:
+        # an ISBN search only finds the book, so the titles don't need checking
+        records = await search_records(f"isbn:{isbn}", "isbn", session)
+        record_lookup(HOST, "isbn", len(records) > 0)
+        if records:
+            return records[0][1]
+
+    search_term = normalise_search_term(book.title)
+    records = await search_records(search_term, "title", session)
+
+    for title, link in records:
+        metrics.increment(HOST, "title_comparisons")
+        if check_titles(title, book.title):
+            record_lookup(HOST, "title", True)
+            return link
+
+    record_lookup(HOST, "title", False)
+    return None
+
+
+async def search_records(
+    query: str,
+    path: str,
+    session: aiohttp.ClientSession,
+) -> List[Tuple[str, str]]:
+    """Search the catalogue, returning the title and link of each record.
+
+    Searches with the same query share the results.
 
-    url = f"https://catalogue.nottinghamcitylibraries.co.uk/search"
+    :param path: "isbn" or "title", for the metrics.
+    """
+    url = SEARCH_URL
     params = {
         "p_p_id": "searchResult_WAR_arenaportlet",
         "p_p_lifecycle": "1",
@@ -50,25 +97,34 @@ async def get_book(
         "p_r_p_arena_urn:arena_facet_queries": "",
         "p_r_p_arena_urn:arena_search_type": "solr",
         "p_r_p_arena_urn:arena_sort_advice": "field=Relevance&direction=Descending",
-        "p_r_p_arena_urn:arena_search_query": search_term,
+        "p_r_p_arena_urn:arena_search_query": query,
     }
-    async with session.get(url=url, params=params) as response:
-        content = await response.read()
 
-        soup = BeautifulSoup(content, "html.parser")
+    async def search():
+        _, content = await fetch(session, url, params)
+        metrics.increment(HOST, f"{path}_bytes", len(content))
+
+        with metrics.time(HOST, "parse"):
+            return parse_records(content)
+
+    return await searches(query, search)
+
 
-        book_divs = soup.find_all("div", {"class": "arena-record"})
-        for book_div in book_divs:
-            title_div = book_div.find("div", {"class": "arena-record-title"})
-            title = title_div.text.split("/")[0].strip()
-            if check_titles(title, book.title):
-                link = title_div.contents[1]
-                return link.attrs["href"]
+def parse_records(content: bytes) -> List[Tuple[str, str]]:
+    """Find the title and link of each record in the search results."""
+    soup = BeautifulSoup(content, "html.parser")
 
-        return None
+    records = []
+    for book_div in soup.find_all("div", {"class": "arena-record"}):
+        title_div = book_div.find("div", {"class": "arena-record-title"})
+        title = title_div.text.split("/")[0].strip()
+        link = title_div.contents[1]
+        records.append((title, link.attrs["href"]))
 
+    return records
 
-async def main():
+
+async def main(argv=None):
     parser = argparse.ArgumentParser(
         prog="check_nottingham_libraries",
         description="Check which books are available in Nottingham libraries.",
@@ -92,8 +148,26 @@ async def main():
         action="store_true",
         help="Clear database of entries for this library before starting.",
     )
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        help="Write request metrics to this file, as JSON lines, or Prometheus text if it ends in .prom.",
+    )
+    parser.add_argument(
+        "--progress",
+        action="store_true",
+        help="Show a progress line on stderr.",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print a summary of the database queries made on exit.",
+    )
+
+    args = parser.parse_args(argv)
 
-    args = parser.parse_args()
+    if args.profile:
+        query_profiler.enable()
 
     database = Database(args.database)
     database.add_library_system(library)
@@ -105,19 +179,29 @@ async def main():
 
     if not args.force:
         # only check books that haven't been checked yet
-        books = [
-            book
-            for book in books
-            if database.check_book_in_library(book, library) is None
-        ]
-
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        for book in books:
-            task = asyncio.ensure_future(process_book(book, database, session))
-            tasks.append(task)
-
-        await asyncio.gather(*tasks)
+        checked = database.get_checked_library_book_ids(library)
+        books = [book for book in books if book.id not in checked]
+
+    if not args.force and not args.clear:
+        # reuse the results of recent searches
+        searches.memo.update(database.get_search_results(HOST, MAX_SEARCH_AGE_DAYS))
+
+    if args.progress:
+        metrics.start_progress(len(books))
+
+    async with aiohttp.ClientSession(trace_configs=[metrics.trace_config()]) as session:
+        async with DatabaseWriter(args.database) as writer:
+            tasks = []
+            for book in books:
+                task = asyncio.ensure_future(process_book(book, writer, session))
+                tasks.append(task)
+
+            await asyncio.gather(*tasks)
+
+    database.add_search_results(HOST, searches.new_results)
+
+    if args.metrics:
+        metrics.write(args.metrics)
 
 
 if __name__ == "__main__":
@@ -1,64 +1,62 @@
 import argparse
 import os
+import time
 from configparser import ConfigParser
 from multiprocessing.pool import ThreadPool
-from sys import executable
 from threading import current_thread
-from typing import Optional, Dict
+from typing import TYPE_CHECKING, Optional, Dict, List, Tuple
 from urllib.parse import urlencode, quote
 
-from selenium import webdriver
-from selenium.webdriver import FirefoxProfile
-from selenium.webdriver.chrome.webdriver import WebDriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.firefox.firefox_binary import FirefoxBinary
-from selenium.webdriver.firefox.options import Options
 from yarl import URL
 
-from check_libraries.common import check_titles
+from check_libraries.common import check_titles, normalise_isbn, record_lookup
 from database import Book, Database, LibrarySystem
+import query_profiler
+from telemetry import metrics
+
+# selenium is slow to import, so it's only imported when it's used
+if TYPE_CHECKING:
+    from selenium.webdriver.remote.webdriver import WebDriver
+    from selenium.webdriver.remote.webelement import WebElement
 
 library = LibrarySystem("Nottingham University")
+HOST = "nusearch.nottingham.ac.uk"
+SEARCH_URL = "https://nusearch.nottingham.ac.uk/primo-explore/search"
 
 # One webdriver for each thread. Maps thread name to driver.
-webdrivers: Dict[str, WebDriver] = {}
+webdrivers: Dict[str, "WebDriver"] = {}
 
 
 def get_book(
     book: Book,
-    driver: WebDriver,
+    driver: "WebDriver",
 ) -> Optional[URL]:
-    """Search Nottingham University library for the book
+    """Search Nottingham University library for the book, by ISBN if it's
+    known, then by title
 
     :return: If the book is found, a URL to the
     search results or the book is returned. Else,
     None is returned.
     """
+    from selenium.webdriver.common.by import By
 
     driver.implicitly_wait(10.0)
 
-    # open page
-    url = "https://nusearch.nottingham.ac.uk/primo-explore/search"
-    params = {
-        "query": f"any,contains,{book.title}",
-        "tab": "44notuk_complete",
-        "search_scope": "44NOTUK_COMPLETE",
-        "vid": "44NOTUK",
-        "offset": "0",
-        "facet": "rtype,exclude,reviews,lk",
-    }
-    query_string = "?" + urlencode(params, quote_via=quote, safe=",")
-    driver.get(url + query_string)
+    isbn = normalise_isbn(book.isbn)
+    if isbn is not None:
+        # an ISBN search only finds the book, so the titles don't need checking
+        book_titles = search_titles(f"isbn,exact,{isbn}", "isbn", driver)
+        record_lookup(HOST, "isbn", len(book_titles) > 0)
+        if book_titles:
+            link = book_titles[0].find_element(by=By.TAG_NAME, value="a")
+            return link.get_attribute("href")
 
-    # get list of book title elements on the search results page
-    search_results_div = driver.find_element(
-        by=By.ID,
-        value="mainResults",
-    )
-    book_titles = search_results_div.find_elements(by=By.CLASS_NAME, value="item-title")
+    book_titles = search_titles(f"any,contains,{book.title}", "title", driver)
 
     # check titles
     for book_title in book_titles:
+        metrics.increment(HOST, "title_comparisons")
+
         # Check title. Sometimes the title is shown as "title / author", so check for
         # this case as well.
         candidate_titles = [book_title.text] + book_title.text.split("/")
@@ -66,33 +64,121 @@ def get_book(
             continue
 
         # return url of book
+        record_lookup(HOST, "title", True)
         link = book_title.find_element(by=By.TAG_NAME, value="a")
         return link.get_attribute("href")
 
+    record_lookup(HOST, "title", False)
     return None
 
 
+def search_titles(query: str, path: str, driver: "WebDriver") -> List["WebElement"]:
+    """Search the library, and get the book title elements on the results page.
+
+    :param path: "isbn" or "title", for the metrics.
+    """
+    from selenium.webdriver.common.by import By
+
+    # open page
+    url = SEARCH_URL
+    params = {
+        "query": query,
+        "tab": "44notuk_complete",
+        "search_scope": "44NOTUK_COMPLETE",
+        "vid": "44NOTUK",
+        "offset": "0",
+        "facet": "rtype,exclude,reviews,lk",
+    }
+    query_string = "?" + urlencode(params, quote_via=quote, safe=",")
+    start = time.perf_counter()
+    driver.get(url + query_string)
+    metrics.record_request(HOST, time.perf_counter() - start, None)
+    metrics.increment(HOST, f"{path}_bytes", len(driver.page_source))
+
+    # get list of book title elements on the search results page
+    with metrics.time(HOST, "parse"):
+        search_results_div = driver.find_element(
+            by=By.ID,
+            value="mainResults",
+        )
+        return search_results_div.find_elements(by=By.CLASS_NAME, value="item-title")
+
+
+def search_book(book: Book) -> Tuple[Optional[URL], Optional[bool]]:
+    """Search for the book, using this thread's webdriver.
+
+    :return: The URL of the book, if it's found, and whether it's present. If
+    the search failed, present is None.
+    """
+    from selenium.common.exceptions import WebDriverException
+
+    driver = webdrivers[current_thread().name]
+    try:
+        url = get_book(book, driver)
+        return url, url is not None
+    except WebDriverException as e:
+        # record the result as unknown, so the book is searched again next time
+        print(book.title, "failed:", e.msg)
+        return None, None
+
+
 def process_book(
     book: Book,
     database_path: str,
 ) -> Optional[URL]:
-    driver = webdrivers[current_thread().name]
-    url = get_book(book, driver)
+    url, present = search_book(book)
 
-    database = Database(database_path)
-    database.add_library_book(library, book, url is not None)
+    with metrics.time(HOST, "db_write"):
+        database = Database(database_path)
+        database.add_library_book(library, book, present)
 
     print(book.title, url)
+    metrics.book_done()
 
     return url
 
 
-def main():
+def create_pool(num_workers: int, config_path: str) -> ThreadPool:
+    """Create a thread pool, with one selenium webdriver for each thread."""
+    from selenium import webdriver
+    from selenium.webdriver import FirefoxProfile
+    from selenium.webdriver.firefox.options import Options
+
+    # open config file
+    config_parser = ConfigParser()
+    config_parser.read(config_path)
+
+    # webdriver options
+    options = Options()
+    options.binary_location = config_parser.get("firefox", "executable")
+    options.profile = FirefoxProfile(
+        config_parser.get("firefox", "profile")
+    )
+    options.add_argument("--headless")
+
+    def init():
+        driver = webdriver.Firefox(options=options)
+        webdrivers[current_thread().name] = driver
+
+    return ThreadPool(num_workers, init)
+
+
+def close_pool(pool: ThreadPool):
+    """Stop the thread pool, and quit the webdriver of each thread."""
+    pool.close()
+    pool.join()
+
+    for driver in webdrivers.values():
+        driver.quit()
+    webdrivers.clear()
+
+
+def main(argv=None):
     root = os.path.dirname(__file__)
 
     parser = argparse.ArgumentParser(
-        prog="check_nottingham_libraries",
-        description="Check which books are available in Nottingham libraries.",
+        prog="check_nottingham_university",
+        description="Check which books are available in Nottingham University library.",
     )
     parser.add_argument(
         "-d",
@@ -120,21 +206,26 @@ def main():
         action="store_true",
         help="Clear database of entries for this library before starting.",
     )
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        help="Write request metrics to this file, as JSON lines, or Prometheus text if it ends in .prom.",
+    )
+    parser.add_argument(
+        "--progress",
+        action="store_true",
+        help="Show a progress line on stderr.",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print a summary of the database queries made on exit.",
+    )
 
-    args = parser.parse_args()
-
-    # open config file
-    config_path = os.path.join(root, "..", "config.ini")
-    config_parser = ConfigParser()
-    config_parser.read(config_path)
+    args = parser.parse_args(argv)
 
-    # webdriver options
-    options = Options()
-    options.binary_location = config_parser.get("firefox", "executable")
-    options.profile = FirefoxProfile(
-        config_parser.get("firefox", "profile")
-    )
-    options.add_argument("--headless")
+    if args.profile:
+        query_profiler.enable()
 
     # open database
     database = Database(args.database)
@@ -148,25 +239,26 @@ def main():
 
     if not args.force:
         # only check books that haven't been checked yet
-        books = [
-            book
-            for book in books
-            if database.check_book_in_library(book, library) is None
-        ]
-
-    # initialise thread pool, and one selenium webdriver for each thread
+        checked = database.get_checked_library_book_ids(library)
+        books = [book for book in books if book.id not in checked]
 
-    def init():
-        driver = webdriver.Firefox(options=options)
-        webdrivers[current_thread().name] = driver
+    if args.progress:
+        metrics.start_progress(len(books))
 
-    pool = ThreadPool(args.num_workers, init)
+    # initialise thread pool, and one selenium webdriver for each thread
+    pool = create_pool(args.num_workers, os.path.join(root, "..", "config.ini"))
 
     # process books
-    pool.starmap(
-        process_book,
-        ((book, args.database) for book in books),
-    )
+    try:
+        pool.starmap(
+            process_book,
+            ((book, args.database) for book in books),
+        )
+    finally:
+        close_pool(pool)
+
+    if args.metrics:
+        metrics.write(args.metrics)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,55 @@
+from typing import Optional
+
 from Levenshtein import distance
 
+from telemetry import metrics
+
 
 def check_titles(title_1, title_2):
     return distance(title_1.lower(), title_2.lower()) < 10
+
+
+def check_author(author: str, listed_author: str) -> bool:
+    """Whether listed_author, e.g. "Tolkien, J. R. R.", could be author, e.g.
+    "J.R.R. Tolkien". Only the surname is compared."""
+    names = author.split()
+    if not names:
+        return True
+
+    return names[-1].lower() in listed_author.lower()
+
+
+def normalise_search_term(title: str) -> str:
+    """Normalise a title for searching. Books with the same normalised title
+    get the same search results."""
+    search_term = title.lower().strip()
+    if search_term.startswith("the "):
+        search_term = search_term[4:]
+
+    return search_term
+
+
+def normalise_isbn(isbn: Optional[str]) -> Optional[str]:
+    """Convert an ISBN to ISBN-13 without hyphens.
+
+    :return: The ISBN-13, or None if isbn isn't a valid ISBN. Storygraph
+    exports can contain other IDs in the ISBN column.
+    """
+    if not isbn:
+        return None
+
+    # isbnlib is slow to import, so only import it when it's needed
+    from isbnlib import canonical, is_isbn10, is_isbn13, to_isbn13
+
+    isbn = canonical(isbn)
+    if is_isbn10(isbn):
+        return to_isbn13(isbn)
+    if is_isbn13(isbn):
+        return isbn
+
+    return None
+
+
+def record_lookup(host: str, path: str, found: bool):
+    """Count whether a search by "isbn" or "title" found the book."""
+    metrics.increment(host, f"{path}_hits" if found else f"{path}_misses")
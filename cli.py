@@ -0,0 +1,57 @@
+"""The book_tools command, which runs each of the scripts as a subcommand.
+
+    book_tools check-all --progress
+    book_tools list -d database.db
+
+Each subcommand's module is only imported when it's run, so heavy dependencies
+(selenium, PySimpleGUI, aiohttp, bs4, isbnlib) aren't imported by commands that
+don't use them.
+"""
+import argparse
+import importlib
+
+# maps each subcommand to the module with its main function, and a description
+COMMANDS = {
+    "list": ("database", "Print the books in the database, or export them."),
+    "query": ("query", "Print the books matching some filters, as a table, CSV or JSON lines."),
+    "view": ("viewer", "Browse the books in a table."),
+    "serve": ("api", "Serve a read-only HTTP API over the database."),
+    "load-storygraph": ("load_storygraph", "Load a Storygraph export."),
+    "load-txt": ("load_from_txt", "Load a text file of titles."),
+    "load-challenge": ("load_challenge", "Load the books in a Storygraph challenge."),
+    "get-tags": ("get_tags", "Get the tags of books from Storygraph."),
+    "check-all": ("check_all", "Check every library and shop."),
+    "check-abebooks": ("check_libraries.check_abebooks", "Check AbeBooks."),
+    "check-libraries-west": ("check_libraries.check_libraries_west", "Check Libraries West."),
+    "check-nottingham-libraries": ("check_libraries.check_nottingham_libraries", "Check Nottingham libraries."),
+    "check-nottingham-university": ("check_libraries.check_nottingham_university", "Check Nottingham University library."),
+    "create-config": ("create_config", "Create an empty config.ini."),
+}
+
+
+def main(argv=None):
+    commands = "\n".join(f"  {name:<30}{description}" for name, (_, description) in COMMANDS.items())
+    parser = argparse.ArgumentParser(
+        prog="book_tools",
+        description="Tools for finding books in libraries and shops.",
+        epilog=f"commands:\n{commands}\n\nRun 'book_tools COMMAND --help' for a command's options.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("command", choices=COMMANDS, metavar="COMMAND")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help="Arguments for the command.")
+
+    args = parser.parse_args(argv)
+
+    module_name, _ = COMMANDS[args.command]
+    module = importlib.import_module(module_name)
+
+    result = module.main(args.args)
+    if result is not None:
+        # the async scripts' main functions return a coroutine
+        import asyncio
+
+        asyncio.run(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,16 @@
+import argparse
 import json
 from configparser import ConfigParser
 from datetime import datetime
 
 
-def main():
+def main(argv=None):
+    argument_parser = argparse.ArgumentParser(
+        "create_config",
+        description="Create an empty config.ini, for the selenium checkers.",
+    )
+    argument_parser.parse_args(argv)
+
     parser = ConfigParser()
 
     parser.add_section("firefox")
@@ -1,17 +1,26 @@
+import argparse
+import importlib
+import json
 import os
+import pathlib
 import sqlite3
-from copy import deepcopy
-from dataclasses import dataclass, fields, field
-from typing import Optional, List, Iterable, Tuple
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+from dataclasses import MISSING, dataclass, fields, field
+from functools import lru_cache
+from typing import Any, Dict, Optional, List, Iterable, Iterator, Tuple, Set, Type, TypeVar
 import re
 
-@dataclass
+import query_profiler
+
+
+@dataclass(slots=True)
 class Author:
     name: Optional[str] = None
     id: Optional[int] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class Book:
     isbn: Optional[str] = None
     title: Optional[str] = None
@@ -21,32 +30,156 @@ class Book:
     authors: List[Author] = field(default_factory=list)
 
 
-@dataclass
+@dataclass(slots=True)
 class LibrarySystem:
     name: Optional[str] = None
     id: Optional[int] = None
 
-@dataclass
+@dataclass(slots=True)
 class Challenge:
     name: Optional[str] = None
     id: Optional[int] = None
 
-@dataclass
+@dataclass(slots=True)
 class Shop:
     name: Optional[str] = None
     id: Optional[int] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class Tag:
     name: Optional[str] = None
     id: Optional[int] = None
 
 
+@dataclass(slots=True)
+class BookFilter:
+    """Conditions on the books returned by iter_book_rows. Libraries, shops and
+    challenges are given by name."""
+    read: Optional[bool] = None
+    # the book must have all of these tags
+    tags: List[str] = field(default_factory=list)
+    # the book must be present in all of these libraries
+    present_in: List[str] = field(default_factory=list)
+    # whether the book is present in at least one library
+    in_library: Optional[bool] = None
+    # the book must be in this shop, with a price in the range. Without a shop,
+    # the range applies to the lowest price in any shop.
+    shop: Optional[str] = None
+    min_price: Optional[float] = None
+    max_price: Optional[float] = None
+    challenge: Optional[str] = None
+    # the book's title, authors or tags must contain every word, or a word
+    # starting with it
+    search: Optional[str] = None
+    # only search these of "title", "authors" and "tags"
+    search_columns: List[str] = field(default_factory=list)
+    # only these books
+    ids: Optional[List[int]] = None
+
+
+# A read-only book row, without authors, for bulk queries
+BookRow = namedtuple("BookRow", ["isbn", "title", "id", "read", "tags_searched"])
+
+
+# the table each type of entity is stored in
+ENTITY_TABLES = {
+    Author: "Author",
+    Book: "Book",
+    LibrarySystem: "LibrarySystem",
+    Shop: "Shop",
+    Challenge: "Challenge",
+    Tag: "Tag",
+}
+
+Entity = TypeVar("Entity")
+
+
+@lru_cache(maxsize=None)
+def entity_columns(cls) -> Tuple[str, ...]:
+    """The fields of an entity that are columns of its table. Fields with a
+    default factory, like Book.authors, are stored in other tables."""
+    return tuple(f.name for f in fields(cls) if f.default_factory is MISSING)
+
+
+@lru_cache(maxsize=256)
+def compile_items_query(
+    cls,
+    filters: Tuple[Tuple[str, str], ...],
+    order_by: str,
+    descending: bool,
+    after: bool,
+) -> str:
+    """Compile the query for get_items. The SQL only depends on the shape of
+    the query, so it's built once, and sqlite reuses the prepared statement.
+
+    :param filters: The name of each filtered column, and its kind of filter:
+    "=", "null", or "in", for a list of values given as one JSON parameter.
+    :param after: Whether to start after a given value of order_by and id.
+    """
+    columns = entity_columns(cls)
+    for name in [name for name, _ in filters] + [order_by]:
+        if name not in columns:
+            raise ValueError(f"{cls.__name__} has no column {name!r}")
+
+    conditions = []
+    for name, kind in filters:
+        if kind == "null":
+            conditions.append(f"{name} IS NULL")
+        elif kind == "in":
+            conditions.append(f"{name} IN (SELECT value FROM json_each(?))")
+        else:
+            conditions.append(f"{name} = ?")
+
+    direction = "DESC" if descending else "ASC"
+    if after:
+        if order_by == "id":
+            conditions.append("id < ?" if descending else "id > ?")
+        elif descending:
+            # NULLs come last in descending order
+            conditions.append(
+                f"({order_by} < ? OR ({order_by} IS ? AND id < ?) OR ({order_by} IS NULL AND ? IS NOT NULL))"
+            )
+        else:
+            # NULLs come first in ascending order
+            conditions.append(
+                f"({order_by} > ? OR ({order_by} IS ? AND id > ?) OR ({order_by} IS NOT NULL AND ? IS NULL))"
+            )
+
+    order = f"{order_by} {direction}" if order_by == "id" else f"{order_by} {direction}, id {direction}"
+    return (
+        f"SELECT {', '.join(columns)}\n"
+        f"FROM {ENTITY_TABLES[cls]}\n"
+        + (f"WHERE {' AND '.join(conditions)}\n" if conditions else "")
+        + f"ORDER BY {order}\n"
+        "LIMIT ?"
+    )
+
+
+# The price history of a book in a shop. first and latest are the oldest and
+# newest recorded prices, and changes is the number of prices recorded.
+PriceSummary = namedtuple(
+    "PriceSummary", ["book", "latest", "minimum", "first", "changes", "observed_at"]
+)
+
+
 class NotFound(Exception):
     pass
 
 
+# punctuation ignored when looking up books by title or isbn
+PUNCTUATION = ["'", '"', ".", ",", "/", ":"]
+
+
+@lru_cache(maxsize=1024)
+def punctuation_pattern(value: str) -> "re.Pattern":
+    """Compile a regex matching value, with its punctuation optional."""
+    return re.compile("".join(
+        c + ("?" if c in PUNCTUATION else "")
+        for c in re.escape(value)
+    ))
+
+
 def first(iterable, pred):
     for item in iterable:
         if pred(item):
@@ -55,14 +188,329 @@ def first(iterable, pred):
     raise RuntimeError("None satisfy predicate.")
 
 
+# The summary of a book's availability, kept up to date by triggers. in_library
+# is whether the book is present in any library, min_price is its lowest price
+# in any shop that has it, and challenges are the ids of its challenges.
+BookSummary = namedtuple(
+    "BookSummary", ["book", "read", "in_library", "min_price", "tag_count", "challenges"]
+)
+
+# The expression for each column of BookSummary, given the id of the book, and
+# the table it's calculated from.
+BOOK_SUMMARY_COLUMNS = {
+    "in_library": (
+        "LibraryBook",
+        "EXISTS (SELECT * FROM LibraryBook WHERE LibraryBook.book = {book} AND LibraryBook.present)",
+    ),
+    "min_price": (
+        "ShopBook",
+        "(SELECT min(ShopBook.price) FROM ShopBook WHERE ShopBook.book = {book} AND ShopBook.present)",
+    ),
+    "tag_count": (
+        "BookTag",
+        "(SELECT count(*) FROM BookTag WHERE BookTag.book = {book})",
+    ),
+    "challenges": (
+        "ChallengeBook",
+        """(
+            SELECT group_concat(challenge, ',') FROM (
+                SELECT ChallengeBook.challenge FROM ChallengeBook
+                WHERE ChallengeBook.book = {book}
+                ORDER BY ChallengeBook.challenge
+            )
+        )""",
+    ),
+}
+
+
+def summarise_books() -> str:
+    """SQL summarising every book in Book."""
+    columns = ", ".join(BOOK_SUMMARY_COLUMNS)
+    expressions = ", ".join(
+        expression.format(book="Book.id") for _, expression in BOOK_SUMMARY_COLUMNS.values()
+    )
+    return f"""
+        INSERT OR REPLACE INTO BookSummary (book, read, {columns})
+        SELECT Book.id, Book.read, {expressions} FROM Book
+    """
+
+
+def summary_triggers(column: str, columns: str) -> str:
+    """SQL creating triggers to keep a column of BookSummary up to date with its table.
+
+    :param columns: The columns of the table the summary depends on.
+    """
+    table, expression = BOOK_SUMMARY_COLUMNS[column]
+
+    def update(book: str, condition: str = "") -> str:
+        return f"UPDATE BookSummary SET {column} = {expression.format(book=book)} WHERE book = {book} {condition};"
+
+    return f"""
+    CREATE TRIGGER IF NOT EXISTS {table}_summary_insert AFTER INSERT ON {table}
+    BEGIN {update("NEW.book")} END;
+    CREATE TRIGGER IF NOT EXISTS {table}_summary_update AFTER UPDATE OF {columns} ON {table}
+    BEGIN
+        {update("NEW.book")}
+        {update("OLD.book", "AND OLD.book IS NOT NEW.book")}
+    END;
+    CREATE TRIGGER IF NOT EXISTS {table}_summary_delete AFTER DELETE ON {table}
+    BEGIN {update("OLD.book")} END;
+    """
+
+
+# The expression for each column of BookSearch made from other tables, given
+# the id of the book, and the table it's made from.
+BOOK_SEARCH_COLUMNS = {
+    "authors": (
+        "BookAuthor",
+        """(
+            SELECT group_concat(Author.name, ' ')
+            FROM BookAuthor INNER JOIN Author ON (BookAuthor.author = Author.id)
+            WHERE BookAuthor.book = {book}
+        )""",
+    ),
+    "tags": (
+        "BookTag",
+        """(
+            SELECT group_concat(Tag.name, ' ')
+            FROM BookTag INNER JOIN Tag ON (BookTag.tag = Tag.id)
+            WHERE BookTag.book = {book}
+        )""",
+    ),
+}
+
+
+def search_triggers(column: str, name_table: str) -> str:
+    """SQL creating triggers to keep a column of BookSearch up to date with its
+    table, and the table of names it refers to."""
+    table, expression = BOOK_SEARCH_COLUMNS[column]
+    # e.g. BookAuthor.author
+    name_column = name_table.lower()
+
+    def update(book: str, condition: str = "") -> str:
+        return f"UPDATE BookSearch SET {column} = {expression.format(book=book)} WHERE rowid = {book} {condition};"
+
+    return f"""
+    CREATE TRIGGER IF NOT EXISTS {table}_search_insert AFTER INSERT ON {table}
+    BEGIN {update("NEW.book")} END;
+    CREATE TRIGGER IF NOT EXISTS {table}_search_update AFTER UPDATE OF book, {name_column} ON {table}
+    BEGIN
+        {update("NEW.book")}
+        {update("OLD.book", "AND OLD.book IS NOT NEW.book")}
+    END;
+    CREATE TRIGGER IF NOT EXISTS {table}_search_delete AFTER DELETE ON {table}
+    BEGIN {update("OLD.book")} END;
+    CREATE TRIGGER IF NOT EXISTS {name_table}_search_update AFTER UPDATE OF name ON {name_table}
+    BEGIN
+        UPDATE BookSearch SET {column} = {expression.format(book="BookSearch.rowid")}
+        WHERE rowid IN (SELECT book FROM {table} WHERE {name_column} = NEW.id);
+    END;
+    """
+
+
+def search_query(text: str, columns: Iterable[str] = ()) -> Optional[str]:
+    """Convert text to an FTS5 query for the books containing every word in it,
+    or words starting with it. Returns None if the text has no words.
+
+    :param columns: Only search these columns of BookSearch. By default, the
+    title, authors and tags are searched.
+    """
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+
+    query = " ".join(f'"{word}"*' for word in words)
+    if columns:
+        query = f"{{{' '.join(columns)}}} : ({query})"
+
+    return query
+
+
+def import_optional(name: str, purpose: str):
+    """Import an optional dependency, with a clearer error if it's missing."""
+    try:
+        return importlib.import_module(name)
+    except ImportError as e:
+        raise ImportError(f"{purpose} needs {name.split('.')[0]}, which isn't installed.") from e
+
+
+# tables of the catalogue that can be exported by export_columnar
+EXPORT_TABLES = ["books", "tags", "availability"]
+
+
+# Schema changes applied on top of the initial schema. The database's user_version
+# is the number of migrations that have been applied, so new migrations must only
+# ever be appended.
+MIGRATIONS = [
+    """
+    CREATE INDEX IF NOT EXISTS ChallengeBook_challenge_book
+    ON ChallengeBook (challenge, book);
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS Tag_name ON Tag (name);
+    CREATE INDEX IF NOT EXISTS BookTag_tag_book ON BookTag (tag, book);
+    CREATE INDEX IF NOT EXISTS BookTag_book_tag ON BookTag (book, tag);
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS LibraryBook_book_library ON LibraryBook (book, library);
+    CREATE INDEX IF NOT EXISTS ShopBook_book_shop ON ShopBook (book, shop);
+    CREATE INDEX IF NOT EXISTS BookAuthor_book ON BookAuthor (book);
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS Book_title ON Book (title COLLATE NOCASE);
+    CREATE INDEX IF NOT EXISTS Book_read ON Book (read);
+    CREATE INDEX IF NOT EXISTS ShopBook_shop_price ON ShopBook (shop, price);
+    CREATE INDEX IF NOT EXISTS LibraryBook_library_present ON LibraryBook (library, present);
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ChallengeBook_book_challenge ON ChallengeBook (book, challenge);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS SearchResult (
+        id INTEGER PRIMARY KEY,
+        source TEXT,
+        query TEXT,
+        result TEXT,
+        searched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (source, query)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS ShopPrice (
+        id INTEGER PRIMARY KEY,
+        shop INTEGER,
+        book INTEGER,
+        price REAL,
+        shipping REAL,
+        observed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (shop) REFERENCES Shop(id),
+        FOREIGN KEY (book) REFERENCES Book(id)
+    );
+    CREATE INDEX IF NOT EXISTS ShopPrice_book_observed_at ON ShopPrice (book, observed_at);
+    CREATE INDEX IF NOT EXISTS ShopPrice_shop_book ON ShopPrice (shop, book, observed_at);
+
+    -- start the history with the prices already known
+    INSERT INTO ShopPrice (shop, book, price)
+    SELECT shop, book, price FROM ShopBook WHERE present IS NOT NULL;
+    """,
+    """
+    ALTER TABLE ShopBook ADD COLUMN offer_count INTEGER;
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS BookSummary (
+        book INTEGER PRIMARY KEY,
+        read BOOLEAN,
+        in_library BOOLEAN,
+        min_price REAL,
+        tag_count INTEGER,
+        challenges TEXT,
+        FOREIGN KEY (book) REFERENCES Book(id)
+    );
+    CREATE INDEX IF NOT EXISTS BookSummary_read_in_library_price
+    ON BookSummary (read, in_library, min_price);
+    CREATE INDEX IF NOT EXISTS BookSummary_min_price ON BookSummary (min_price);
+
+    -- summarise new books from Book alone, since nothing refers to them yet
+    CREATE TRIGGER IF NOT EXISTS Book_summary_insert AFTER INSERT ON Book
+    BEGIN
+        INSERT OR REPLACE INTO BookSummary (book, read, in_library, tag_count)
+        VALUES (NEW.id, NEW.read, 0, 0);
+    END;
+    CREATE TRIGGER IF NOT EXISTS Book_summary_update AFTER UPDATE OF read ON Book
+    BEGIN UPDATE BookSummary SET read = NEW.read WHERE book = NEW.id; END;
+    CREATE TRIGGER IF NOT EXISTS Book_summary_delete AFTER DELETE ON Book
+    BEGIN DELETE FROM BookSummary WHERE book = OLD.id; END;
+
+    {summary_triggers("in_library", "book, present")}
+    {summary_triggers("min_price", "book, present, price")}
+    {summary_triggers("tag_count", "book")}
+    {summary_triggers("challenges", "book")}
+
+    {summarise_books()};
+    """,
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS BookSearch USING fts5(
+        title,
+        authors,
+        tags,
+        tokenize = 'unicode61 remove_diacritics 2'
+    );
+
+    CREATE TRIGGER IF NOT EXISTS Book_search_insert AFTER INSERT ON Book
+    BEGIN
+        INSERT INTO BookSearch (rowid, title) VALUES (NEW.id, NEW.title);
+    END;
+    CREATE TRIGGER IF NOT EXISTS Book_search_update AFTER UPDATE OF title ON Book
+    BEGIN UPDATE BookSearch SET title = NEW.title WHERE rowid = NEW.id; END;
+    CREATE TRIGGER IF NOT EXISTS Book_search_delete AFTER DELETE ON Book
+    BEGIN DELETE FROM BookSearch WHERE rowid = OLD.id; END;
+
+    {search_triggers("authors", "Author")}
+    {search_triggers("tags", "Tag")}
+
+    INSERT INTO BookSearch (rowid, title, authors, tags)
+    SELECT
+        Book.id,
+        Book.title,
+        {BOOK_SEARCH_COLUMNS["authors"][1].format(book="Book.id")},
+        {BOOK_SEARCH_COLUMNS["tags"][1].format(book="Book.id")}
+    FROM Book;
+    """,
+    """
+    -- get_author set BookAuthor.author to the author's name, rather than its id,
+    -- when the author already existed
+    UPDATE BookAuthor
+    SET author = (SELECT min(Author.id) FROM Author WHERE Author.name = BookAuthor.author)
+    WHERE typeof(author) = 'text' AND author IN (SELECT name FROM Author);
+
+    -- merge authors with the same name into the first of them
+    UPDATE BookAuthor
+    SET author = (
+        SELECT min(Duplicate.id) FROM Author
+        INNER JOIN Author AS Duplicate ON (Duplicate.name IS Author.name)
+        WHERE Author.id = BookAuthor.author
+    )
+    WHERE author NOT IN (SELECT min(id) FROM Author GROUP BY name);
+    DELETE FROM Author WHERE id NOT IN (SELECT min(id) FROM Author GROUP BY name);
+    DELETE FROM BookAuthor WHERE id NOT IN (SELECT min(id) FROM BookAuthor GROUP BY book, author);
+
+    CREATE UNIQUE INDEX IF NOT EXISTS Author_name ON Author (name);
+    CREATE INDEX IF NOT EXISTS BookAuthor_author_book ON BookAuthor (author, book);
+    """,
+    """
+    -- get_book finds books by isbn with LIKE, which can only use a NOCASE index
+    CREATE INDEX IF NOT EXISTS Book_isbn ON Book (isbn COLLATE NOCASE);
+    """,
+]
+
+
 class Database:
-    def __init__(self, path: str):
-        init = not os.path.exists(path)
-        self._connection = sqlite3.connect(path)
+    def __init__(self, path: str, read_only: bool = False):
+        """
+        :param read_only: Open the database read only. The connection can be
+        used from any thread, but only by one thread at a time. The database
+        must exist, and be migrated.
+        """
+        if read_only:
+            uri = pathlib.Path(path).absolute().as_uri() + "?mode=ro"
+            self._connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            init = not os.path.exists(path)
+            self._connection = sqlite3.connect(path)
+
         self._cursor = self._connection.cursor()
+        self._transaction_depth = 0
+        # maps the name of each author looked up to its id
+        self._author_ids: Dict[str, int] = {}
 
-        if init:
-            self._initialise_database()
+        if not read_only:
+            if init:
+                self._initialise_database()
+
+            self._migrate()
+
+        if query_profiler.profiler is not None:
+            query_profiler.profiler.instrument(self)
 
     def _initialise_database(self):
         self._cursor.execute(
@@ -176,6 +624,42 @@ class Database:
         )
         self._connection.commit()
 
+    def _migrate(self):
+        self._cursor.execute("PRAGMA user_version")
+        version, = self._cursor.fetchone()
+
+        for new_version, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            self._cursor.executescript(migration)
+            self._cursor.execute(f"PRAGMA user_version = {new_version}")
+
+        self._connection.commit()
+
+    @contextmanager
+    def transaction(self):
+        """Group writes into a single transaction.
+
+        Methods called inside the block don't commit. The transaction is
+        committed when the outermost block exits, or rolled back on an error.
+        """
+        self._transaction_depth += 1
+        try:
+            yield
+        except BaseException:
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                self._connection.rollback()
+                # authors added in the transaction no longer exist
+                self._author_ids.clear()
+            raise
+
+        self._transaction_depth -= 1
+        if self._transaction_depth == 0:
+            self._connection.commit()
+
+    def _commit(self):
+        if self._transaction_depth == 0:
+            self._connection.commit()
+
     def add_challenge(self, challenge: Challenge):
         if self.challenge_exists(challenge):
             # set challenge id
@@ -190,7 +674,7 @@ class Database:
             """,
             (challenge.name,)
         )
-        self._connection.commit()
+        self._commit()
 
         challenge.id = self._cursor.lastrowid
 
@@ -199,9 +683,7 @@ class Database:
             return
 
         # insert authors
-        for author in book.authors:
-            if not self.get_author(author):
-                self.add_author(author)
+        self.resolve_authors(book.authors)
 
         # insert book
         self._cursor.execute(
@@ -215,39 +697,79 @@ class Database:
         book.id = self._cursor.lastrowid
 
         # relate book to authors
-        for author in book.authors:
-            self._cursor.execute(
-                """
-                INSERT INTO BookAuthor (book, author)
-                VALUES (?, ?)
-                """,
-                (book.id, author.id),
-            )
+        self._cursor.executemany(
+            """
+            INSERT INTO BookAuthor (book, author)
+            VALUES (?, ?)
+            """,
+            ((book.id, author.id) for author in book.authors),
+        )
 
-        self._connection.commit()
+        self._commit()
 
 
     def add_author(self, author: Author):
-        if self.get_author(author):
-            return
+        self.resolve_authors([author])
 
-        # insert author
-        self._cursor.execute(
-            """
-            INSERT INTO Author (name)
-            VALUES (?)
-            """,
-            (author.name,)
-        )
-
-        author.id = self._cursor.lastrowid
+    def resolve_authors(self, authors: Iterable[Author]):
+        """Set the id of each author, adding the authors that don't exist.
 
-        self._connection.commit()
+        All the authors are looked up in one query, and their ids are cached,
+        so resolve the authors of a batch of books together, e.g.
+        resolve_authors(author for book in books for author in book.authors).
+        """
+        authors = list(authors)
+        if any(author.name is None for author in authors):
+            raise ValueError("Authors must have a name.")
+
+        missing = {author.name for author in authors if author.name not in self._author_ids}
+
+        if missing:
+            self._lookup_authors(missing)
+
+            new_names = missing - self._author_ids.keys()
+            if new_names:
+                self._cursor.executemany(
+                    """
+                    INSERT OR IGNORE INTO Author (name)
+                    VALUES (?)
+                    """,
+                    ((name,) for name in new_names),
+                )
+                self._lookup_authors(new_names)
+                self._commit()
+
+        for author in authors:
+            author.id = self._author_ids[author.name]
+
+    def _lookup_authors(self, names: Set[str]):
+        """Add the ids of the authors that exist to the cache."""
+        names = list(names)
+        # stay well under sqlite's limit on the number of parameters
+        for start in range(0, len(names), 500):
+            chunk = names[start:start + 500]
+            self._cursor.execute(
+                f"""
+                SELECT name, id
+                FROM Author
+                WHERE name IN ({', '.join('?' * len(chunk))})
+                """,
+                chunk,
+            )
+            self._author_ids.update(self._cursor.fetchall())
 
     def update_book(self, book: Book):
-        # get book id and check if it exists
-        if not self.get_book(book):
-            raise RuntimeError("Book doesn't exist")
+        """Save the book's isbn, title, read and tags_searched.
+
+        The book is found by id, or if it doesn't have one, by isbn or title.
+        Its fields aren't reloaded from the database, so they aren't lost.
+        """
+        if book.id is None:
+            # look up the id with a copy, since get_book overwrites the fields
+            stored = Book(isbn=book.isbn, title=book.title)
+            if not self.get_book(stored):
+                raise RuntimeError("Book doesn't exist")
+            book.id = stored.id
 
         # update book
         self._cursor.execute(
@@ -258,7 +780,28 @@ class Database:
             """,
             (book.isbn, book.title, book.read, book.tags_searched, book.id),
         )
-        self._connection.commit()
+        if self._cursor.rowcount == 0:
+            raise RuntimeError("Book doesn't exist")
+        self._commit()
+
+    def set_tags_searched(self, books: List[Book]):
+        """Record that the tags of the books have been searched for."""
+        book_ids = [book.id for book in books]
+        # stay well under sqlite's limit on the number of parameters
+        for start in range(0, len(book_ids), 500):
+            chunk = book_ids[start:start + 500]
+            self._cursor.execute(
+                f"""
+                UPDATE Book
+                SET tags_searched = 1
+                WHERE id IN ({', '.join('?' * len(chunk))})
+                """,
+                chunk,
+            )
+        self._commit()
+
+        for book in books:
+            book.tags_searched = True
 
     def get_books(self, read=None) -> List[Book]:
         query = "SELECT isbn, title, id, read, tags_searched FROM Book"
@@ -271,27 +814,353 @@ class Database:
         self._cursor.execute(query, tuple(params))
         books = [Book(*row) for row in self._cursor.fetchall()]
 
-        # get authors
+        # get the authors of every book in one query
+        self._cursor.execute(
+            """
+            SELECT BookAuthor.book, Author.name, Author.id
+            FROM BookAuthor
+            INNER JOIN Author ON BookAuthor.author = Author.id
+            """
+        )
+        authors = defaultdict(list)
+        for book_id, name, author_id in self._cursor.fetchall():
+            authors[book_id].append(Author(name, author_id))
+
         for book in books:
-            self._cursor.execute(
-                """
-                SELECT Author.name, Author.id
-                FROM BookAuthor
-                INNER JOIN Author ON BookAuthor.author = Author.id
-                WHERE BookAuthor.book = ?
-                """,
-                (book.id,),
+            book.authors = authors.get(book.id, [])
+
+        return books
+
+    def get_book_rows(self, read=None) -> List[BookRow]:
+        """Like get_books, but returns lightweight read-only rows, without authors."""
+        query = "SELECT isbn, title, id, read, tags_searched FROM Book"
+        params = []
+
+        if read is not None:
+            query += " WHERE read = ?"
+            params.append(read)
+
+        self._cursor.execute(query, tuple(params))
+        return [BookRow._make(row) for row in self._cursor.fetchall()]
+
+    def iter_book_rows(
+        self,
+        libraries: List[LibrarySystem],
+        shops: List[Shop],
+        batch_size: int = 500,
+        order_by: Optional[int] = None,
+        descending: bool = False,
+        book_filter: Optional[BookFilter] = None,
+        limit: Optional[int] = None,
+        offset: int = 0,
+    ) -> Iterator[List[tuple]]:
+        """Stream a row for each book, in batches.
+
+        Each row is (id, title, read, tags, challenges, authors), followed by
+        whether the book is present in each library, and its price in each shop.
+        Tags, challenges and authors are comma separated.
+
+        :param order_by: Index of the column in the row to sort by. By default,
+        the rows are sorted by the price in the last shop.
+        :param book_filter: Only include the books matching the filter. The
+        filter is part of the same query.
+        """
+        library_joins = [
+            f"LEFT JOIN LibraryBook AS Library{i} "
+            f"ON (Library{i}.book = Book.id AND Library{i}.library = ?)"
+            for i in range(len(libraries))
+        ]
+        shop_joins = [
+            f"LEFT JOIN ShopBook AS Shop{i} "
+            f"ON (Shop{i}.book = Book.id AND Shop{i}.shop = ?)"
+            for i in range(len(shops))
+        ]
+        columns = [
+            "Book.id",
+            "Book.title",
+            "Book.read",
+            """(
+                SELECT group_concat(Tag.name, ', ')
+                FROM BookTag INNER JOIN Tag ON (BookTag.tag = Tag.id)
+                WHERE BookTag.book = Book.id
+            )""",
+            """(
+                SELECT group_concat(Challenge.name, ', ')
+                FROM ChallengeBook INNER JOIN Challenge ON (ChallengeBook.challenge = Challenge.id)
+                WHERE ChallengeBook.book = Book.id
+            )""",
+            """(
+                SELECT group_concat(Author.name, ', ')
+                FROM BookAuthor INNER JOIN Author ON (BookAuthor.author = Author.id)
+                WHERE BookAuthor.book = Book.id
+            )""",
+        ]
+        columns += [f"Library{i}.present" for i in range(len(libraries))]
+        columns += [f"Shop{i}.price" for i in range(len(shops))]
+        params = [library.id for library in libraries] + [shop.id for shop in shops]
+
+        direction = "DESC" if descending else "ASC"
+        if order_by is None:
+            if shops:
+                order = f"COALESCE(Shop{len(shops) - 1}.price, 0) {direction}"
+            else:
+                order = f"Book.id {direction}"
+        elif order_by == 1:
+            # uses the Book_title index
+            order = f"Book.title COLLATE NOCASE {direction}"
+        else:
+            # refer to the column by position, so subqueries aren't evaluated twice
+            order = f"{order_by + 1} {direction}"
+
+        conditions = []
+        if book_filter is not None:
+            conditions, filter_params = self._compile_book_filter(book_filter)
+            params += filter_params
+
+        query = (
+            f"SELECT {', '.join(columns)}\n"
+            "FROM Book\n"
+            + "".join(join + "\n" for join in library_joins + shop_joins)
+            + "".join(f"{'WHERE' if i == 0 else 'AND'} {condition}\n" for i, condition in enumerate(conditions))
+            + f"ORDER BY {order}, Book.id {direction}"
+        )
+        if limit is not None or offset:
+            query += "\nLIMIT ? OFFSET ?"
+            params += [-1 if limit is None else limit, offset]
+
+        # use a separate cursor, so other queries can be made between batches
+        cursor = self._connection.cursor()
+        cursor.execute(query, params)
+        while rows := cursor.fetchmany(batch_size):
+            yield rows
+
+    def _compile_book_filter(self, book_filter: BookFilter) -> Tuple[List[str], list]:
+        """Convert a filter to SQL conditions on Book, and their parameters."""
+        conditions = []
+        params = []
+
+        if book_filter.read is not None:
+            conditions.append("Book.read = ?")
+            params.append(book_filter.read)
+
+        tag_conditions, tag_params = self._tag_conditions(all_of=book_filter.tags)
+        conditions += tag_conditions
+        params += tag_params
+
+        for library in book_filter.present_in:
+            conditions.append(
+                "Book.id IN (\n"
+                "SELECT LibraryBook.book FROM LibraryBook\n"
+                "INNER JOIN LibrarySystem ON (LibraryBook.library = LibrarySystem.id)\n"
+                "WHERE LibrarySystem.name = ? AND LibraryBook.present)"
+            )
+            params.append(library)
+
+        if book_filter.in_library is not None:
+            conditions.append("Book.id IN (SELECT book FROM BookSummary WHERE in_library = ?)")
+            params.append(book_filter.in_library)
+
+        if book_filter.shop is None and (book_filter.min_price is not None or book_filter.max_price is not None):
+            price_conditions = []
+            if book_filter.min_price is not None:
+                price_conditions.append("min_price >= ?")
+                params.append(book_filter.min_price)
+            if book_filter.max_price is not None:
+                price_conditions.append("min_price <= ?")
+                params.append(book_filter.max_price)
+
+            conditions.append(f"Book.id IN (SELECT book FROM BookSummary WHERE {' AND '.join(price_conditions)})")
+
+        if book_filter.shop is not None:
+            price_conditions = ["Shop.name = ?", "ShopBook.present"]
+            params.append(book_filter.shop)
+            if book_filter.min_price is not None:
+                price_conditions.append("ShopBook.price >= ?")
+                params.append(book_filter.min_price)
+            if book_filter.max_price is not None:
+                price_conditions.append("ShopBook.price <= ?")
+                params.append(book_filter.max_price)
+
+            conditions.append(
+                "Book.id IN (\n"
+                "SELECT ShopBook.book FROM ShopBook\n"
+                "INNER JOIN Shop ON (ShopBook.shop = Shop.id)\n"
+                f"WHERE {' AND '.join(price_conditions)})"
             )
 
-            book.authors.clear()
-            for row in self._cursor.fetchall():
-                book.authors.append(Author(*row))
+        if book_filter.ids is not None:
+            conditions.append(f"Book.id IN ({', '.join('?' * len(book_filter.ids))})")
+            params.extend(book_filter.ids)
 
-        return books
+        if book_filter.search is not None:
+            query = search_query(book_filter.search, book_filter.search_columns)
+            if query is None:
+                # nothing to search for
+                conditions.append("0")
+            else:
+                conditions.append("Book.id IN (SELECT rowid FROM BookSearch WHERE BookSearch MATCH ?)")
+                params.append(query)
+
+        if book_filter.challenge is not None:
+            conditions.append(
+                "Book.id IN (\n"
+                "SELECT ChallengeBook.book FROM ChallengeBook\n"
+                "INNER JOIN Challenge ON (ChallengeBook.challenge = Challenge.id)\n"
+                "WHERE Challenge.name = ?)"
+            )
+            params.append(book_filter.challenge)
+
+        return conditions, params
+
+    def _columns(self, table: str, batch_size: int) -> Tuple[List[Tuple[str, str]], Iterator[List[tuple]]]:
+        """The names and types of the columns in a table, and its columns in batches.
+
+        "books" has a row for each book, with a column for whether the book is
+        present in each library, and its price in each shop, named after the
+        library or shop. Its tags, challenges and authors are comma separated.
+
+        "tags" has a (book, tag) row for each tag of each book, and
+        "availability" a (book, source, present, price) row for each library
+        and shop a book has been checked in, so they can be aggregated without
+        splitting strings or knowing the libraries and shops.
+        """
+        if table == "tags":
+            schema = [("book", "int"), ("tag", "str")]
+            query = """
+                SELECT BookTag.book, Tag.name
+                FROM BookTag
+                INNER JOIN Tag ON (BookTag.tag = Tag.id)
+                ORDER BY BookTag.book, Tag.name
+            """
+            return schema, self._query_columns(query, batch_size)
+
+        if table == "availability":
+            schema = [("book", "int"), ("source", "str"), ("present", "bool"), ("price", "float")]
+            query = """
+                SELECT LibraryBook.book, LibrarySystem.name, LibraryBook.present, NULL
+                FROM LibraryBook
+                INNER JOIN LibrarySystem ON (LibraryBook.library = LibrarySystem.id)
+                UNION ALL
+                SELECT ShopBook.book, Shop.name, ShopBook.present, ShopBook.price
+                FROM ShopBook
+                INNER JOIN Shop ON (ShopBook.shop = Shop.id)
+                ORDER BY 1, 2
+            """
+            return schema, self._query_columns(query, batch_size)
+
+        if table != "books":
+            raise ValueError(f"Unknown table {table!r}")
+
+        libraries = self.get_libraries()
+        shops = self.get_shops()
+
+        schema = [
+            ("id", "int"),
+            ("title", "str"),
+            ("read", "bool"),
+            ("tags", "str"),
+            ("challenges", "str"),
+            ("authors", "str"),
+        ]
+        schema += [(f"{library.name} present", "bool") for library in libraries]
+        schema += [(f"{shop.name} price", "float") for shop in shops]
+
+        def batches():
+            # sorted by id, so the output is stable
+            for rows in self.iter_book_rows(libraries, shops, batch_size, order_by=0):
+                yield list(zip(*rows))
+
+        return schema, batches()
+
+    def _query_columns(self, query: str, batch_size: int) -> Iterator[List[tuple]]:
+        """Stream the columns of the rows of a query, in batches."""
+        # use a separate cursor, so other queries can be made between batches
+        cursor = self._connection.cursor()
+        cursor.execute(query)
+        while rows := cursor.fetchmany(batch_size):
+            yield list(zip(*rows))
+
+    def _arrow_batches(self, table: str, batch_size: int):
+        pa = import_optional("pyarrow", "Columnar export")
+        types = {"int": pa.int64(), "str": pa.string(), "bool": pa.bool_(), "float": pa.float64()}
+
+        columns, batches = self._columns(table, batch_size)
+        schema = pa.schema([(name, types[kind]) for name, kind in columns])
+
+        def arrow_batches():
+            for batch in batches:
+                arrays = []
+                for (_, kind), column in zip(columns, batch):
+                    if kind == "bool":
+                        # sqlite stores booleans as integers
+                        column = [None if value is None else bool(value) for value in column]
+                    arrays.append(pa.array(column, type=types[kind]))
+                yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+        return schema, arrow_batches()
+
+    def to_arrow(self, batch_size: int = 10000, table: str = "books"):
+        """Load a table of the catalogue into an Arrow table.
+
+        Requires pyarrow.
+
+        :param table: One of EXPORT_TABLES, as described in _columns.
+        """
+        pa = import_optional("pyarrow", "Columnar export")
+        schema, batches = self._arrow_batches(table, batch_size)
+        return pa.Table.from_batches(list(batches), schema=schema)
+
+    def to_pandas(self, batch_size: int = 10000, table: str = "books"):
+        """Load a table of the catalogue into a pandas DataFrame.
+
+        Requires pyarrow and pandas.
+        """
+        pd = import_optional("pandas", "Columnar export")
+        pa = import_optional("pyarrow", "Columnar export")
+        # use pandas' nullable boolean type, rather than objects, for unknown availability
+        return self.to_arrow(batch_size, table).to_pandas(types_mapper={pa.bool_(): pd.BooleanDtype()}.get)
+
+    def export_columnar(self, path: str, format: str = "parquet", batch_size: int = 10000, table: str = "books"):
+        """Write a table of the catalogue to a column-oriented file.
+
+        :param format: "parquet", which requires pyarrow, or "npz", which
+        requires numpy. Parquet files are written a batch at a time. npz files
+        can't be appended to, so the columns are built in memory and written at
+        the end; use parquet for large catalogues. In npz files, unknown
+        availability is NaN, and missing text is an empty string.
+        :param table: One of EXPORT_TABLES, as described in _columns.
+        """
+        if format == "parquet":
+            pq = import_optional("pyarrow.parquet", "Parquet export")
+            schema, batches = self._arrow_batches(table, batch_size)
+            with pq.ParquetWriter(path, schema) as writer:
+                for batch in batches:
+                    writer.write_batch(batch)
+
+        elif format == "npz":
+            np = import_optional("numpy", "npz export")
+            dtypes = {"int": np.int64, "str": np.str_, "bool": np.float64, "float": np.float64}
+
+            columns, batches = self._columns(table, batch_size)
+            chunks = [[] for _ in columns]
+            for batch in batches:
+                for (_, kind), column, column_chunks in zip(columns, batch, chunks):
+                    if kind == "str":
+                        column = ["" if value is None else value for value in column]
+                    else:
+                        column = [np.nan if value is None else value for value in column]
+                    column_chunks.append(np.array(column, dtype=dtypes[kind]))
+
+            np.savez(path, **{
+                name: np.concatenate(column_chunks) if column_chunks else np.array([], dtype=dtypes[kind])
+                for (name, kind), column_chunks in zip(columns, chunks)
+            })
+
+        else:
+            raise ValueError(f"Unknown format {format!r}")
 
     def get_book(self, book: Book, raise_if_not_found = False):
         fields = ["isbn", "title", "id", "read", "tags_searched"]
-        punctuation = ["'", '"', ".", ",", "/", ":"]
 
         # Query using book id. If not available, use isbn, etc.
         query_params = ["id", "isbn", "title"]  # decreasing order of preference
@@ -305,14 +1174,16 @@ class Database:
         if isinstance(query_param_value, str):
             # Ignore punctuation by replacing it with wildcards
             query_param_value_wildcards = "".join(
-                ("%" if (c in punctuation) else c)
+                ("%" if (c in PUNCTUATION) else c)
                 for c in query_param_value
             )
 
+        # LIKE can't use the primary key, so compare ids directly
+        operator = "=" if query_param == "id" else "LIKE"
         query = (
             f"SELECT {', '.join(fields)}\n"
             "FROM Book\n"
-            f"WHERE {query_param} LIKE ?"
+            f"WHERE {query_param} {operator} ?"
         )
 
         self._cursor.execute(query, (query_param_value_wildcards,))
@@ -327,17 +1198,10 @@ class Database:
         # The punctuation check above doesn't always work, because the wildcards are equivalent to .* in regex. We must
         # verify it with regular expressions.
         if isinstance(query_param_value, str):
+            query_param_index = fields.index(query_param)
+            query_param_re = punctuation_pattern(query_param_value)
             for row in rows:
-                _book = deepcopy(book)
-                for field, value in zip(fields, row):
-                    setattr(_book, field, value)
-
-                found_query_param = getattr(_book, query_param)
-                query_param_re = "".join(
-                    c + ("?" if c in punctuation else "")
-                    for c in re.escape(query_param_value)
-                )
-                if re.match(query_param_re, found_query_param):
+                if query_param_re.match(row[query_param_index]):
                     break
             else:
                 return False
@@ -365,6 +1229,10 @@ class Database:
         return True
 
     def get_author(self, author: Author, raise_if_not_found = False):
+        if author.name in self._author_ids:
+            author.id = self._author_ids[author.name]
+            return True
+
         self._cursor.execute(
             """
             SELECT name, id
@@ -381,7 +1249,8 @@ class Database:
             else:
                 return False
 
-        author.id = rows[0][0]
+        author.id = rows[0][1]
+        self._author_ids[author.name] = author.id
 
         return True
 
@@ -389,42 +1258,20 @@ class Database:
         if isinstance(item, Book):
             return self.get_book(item)
 
-        elif isinstance(item, LibrarySystem):
-            table_name = "LibrarySystem"
-        elif isinstance(item, Shop):
-            table_name = "Shop"
-        elif isinstance(item, Challenge):
-            table_name = "Challenge"
-        else:
+        elif not isinstance(item, (LibrarySystem, Shop, Challenge)):
             raise TypeError
 
         if only_check_id:
             item_fields = ["id"]
         else:
-            item_fields = [f.name for f in fields(item)]
+            item_fields = entity_columns(type(item))
 
-        params_query = []
-        params = []
-        for field in item_fields:
-            if not hasattr(item, field):
-                continue
-
-            value = getattr(item, field)
-            if value is None:
-                continue
-
-
-            params_query.append(f"{field} = ?")
-            params.append(value)
-
-        query = (
-            f"SELECT {', '.join(item_fields)}\n"
-            f"FROM {table_name}\n"
-            f"WHERE {' AND '.join(params_query)}"
-        )
-
-        self._cursor.execute(query, params)
-        rows = self._cursor.fetchall()
+        filters = {
+            field: getattr(item, field)
+            for field in item_fields
+            if getattr(item, field) is not None
+        }
+        rows = next(self.get_items(type(item), limit=2, **filters), [])
 
         if len(rows) == 0:
             raise NotFound("Item not found.")
@@ -432,50 +1279,105 @@ class Database:
             raise RuntimeError("Query satisfies more than one item.")
 
         row, = rows
-        for field, value in zip(item_fields, row):
-            setattr(item, field, value)
-
-    def get_items(self):
-        # TODO:
-        raise NotImplemented
-
-    def check_item_exists(self, item):
-        if isinstance(item, Book):
-            table_name = "Book"
-        elif isinstance(item, LibrarySystem):
-            table_name = "LibrarySystem"
-        else:
-            raise TypeError
+        for field in item_fields:
+            setattr(item, field, getattr(row, field))
 
-        item_fields = [f.name for f in fields(item)]
+    def get_items(
+        self,
+        item_type: Type[Entity],
+        order_by: str = "id",
+        descending: bool = False,
+        limit: Optional[int] = None,
+        after: Optional[Entity] = None,
+        batch_size: int = 500,
+        **filters,
+    ) -> Iterator[List[Entity]]:
+        """Stream the entities of a type matching the filters, in batches.
+
+            for shops in database.get_items(Shop, name=["Abe Books", "Waterstones"]):
+                ...
+
+        Books are returned with their authors.
+
+        :param order_by: Column to sort by. Ties are sorted by id.
+        :param after: The last entity of a previous call, to get the next page
+        of results. Pages are found with the index on order_by, rather than
+        counting the entities before them.
+        :param filters: Conditions on columns. A list, tuple or set matches any
+        of its values, and None matches NULL.
+        """
+        if item_type not in ENTITY_TABLES:
+            raise TypeError(f"{item_type.__name__} isn't stored in the database")
 
-        params_query = []
+        filter_kinds = []
         params = []
-        for field in item_fields:
-            value = getattr(item, field)
+        for name, value in filters.items():
             if value is None:
-                continue
+                filter_kinds.append((name, "null"))
+            elif isinstance(value, (list, tuple, set, frozenset)):
+                filter_kinds.append((name, "in"))
+                params.append(json.dumps(list(value)))
+            else:
+                filter_kinds.append((name, "="))
+                params.append(value)
 
-            params_query.append(f"{field} = ?")
-            params.append(value)
+        if after is not None:
+            if order_by == "id":
+                params.append(after.id)
+            else:
+                value = getattr(after, order_by)
+                params += [value, value, after.id, value]
 
-        query = f"""
-            SELECT {', '.join(item_fields)} 
-            FROM {table_name} 
-            WHERE {' AND '.join(params_query)}
-        """
+        params.append(-1 if limit is None else limit)
+        query = compile_items_query(item_type, tuple(filter_kinds), order_by, descending, after is not None)
 
-        self._cursor.execute(query, params)
-        rows = self._cursor.fetchall()
+        # use a separate cursor, so other queries can be made between batches
+        cursor = self._connection.cursor()
+        cursor.execute(query, params)
+        while rows := cursor.fetchmany(batch_size):
+            items = [item_type(**dict(zip(entity_columns(item_type), row))) for row in rows]
+            if item_type is Book:
+                self._load_authors(items)
 
-        return len(rows) > 0
+            yield items
+
+    def _load_authors(self, books: List[Book]):
+        """Set the authors of the books, in one query."""
+        self._cursor.execute(
+            """
+            SELECT BookAuthor.book, Author.name, Author.id
+            FROM BookAuthor
+            INNER JOIN Author ON BookAuthor.author = Author.id
+            WHERE BookAuthor.book IN (SELECT value FROM json_each(?))
+            """,
+            (json.dumps([book.id for book in books]),),
+        )
+        authors = defaultdict(list)
+        for book_id, name, author_id in self._cursor.fetchall():
+            authors[book_id].append(Author(name, author_id))
+
+        for book in books:
+            book.authors = authors.get(book.id, [])
+
+    def check_item_exists(self, item):
+        if not isinstance(item, (Book, LibrarySystem)):
+            raise TypeError
+
+        filters = {
+            field: getattr(item, field)
+            for field in entity_columns(type(item))
+            if getattr(item, field) is not None
+        }
+
+        return len(next(self.get_items(type(item), limit=1, **filters), [])) > 0
 
     def add_library_book(
         self,
         library: LibrarySystem,
         book: Book,
-        present: bool,
+        present: Optional[bool],
     ):
+        """Record whether a book is in a library. present is None if it's unknown."""
         # get ids
         if library.id is None:
             self.get_item(library)
@@ -501,7 +1403,7 @@ class Database:
                 """,
                 (present, library.id, book.id),
             )
-            self._connection.commit()
+            self._commit()
             return
 
         # add row
@@ -512,7 +1414,7 @@ class Database:
             """,
             (library.id, book.id, present),
         )
-        self._connection.commit()
+        self._commit()
 
     def add_book_to_challenge(
         self,
@@ -544,7 +1446,7 @@ class Database:
             """,
             (challenge.id, book.id),
         )
-        self._connection.commit()
+        self._commit()
 
     def add_library_system(self, library: LibrarySystem):
         # check library doesn't already exist
@@ -565,7 +1467,7 @@ class Database:
             """,
             (library.name,)
         )
-        self._connection.commit()
+        self._commit()
 
     def add_shop(self, shop: Shop):
         # check library doesn't already exist
@@ -586,7 +1488,7 @@ class Database:
             """,
             (shop.name,)
         )
-        self._connection.commit()
+        self._commit()
 
     def get_books_for_library_system(self, library: LibrarySystem):
         if library.id is None:
@@ -605,26 +1507,10 @@ class Database:
         return [Book(*row) for row in self._cursor.fetchall()]
 
     def get_libraries(self):
-        self._cursor.execute(
-            """
-            SELECT id, name FROM LibrarySystem
-            """
-        )
-        return [
-            LibrarySystem(name, id_)
-            for id_, name in self._cursor.fetchall()
-        ]
+        return [library for libraries in self.get_items(LibrarySystem) for library in libraries]
 
     def get_shops(self):
-        self._cursor.execute(
-            """
-            SELECT id, name FROM Shop
-            """
-        )
-        return [
-            Shop(name, id_)
-            for id_, name in self._cursor.fetchall()
-        ]
+        return [shop for shops in self.get_items(Shop) for shop in shops]
 
     def check_book_in_library(
             self, book: Book, library: LibrarySystem
@@ -674,6 +1560,36 @@ class Database:
             present, price = query_result[0]
             return present, price
 
+    def get_checked_library_book_ids(self, library: LibrarySystem) -> Set[int]:
+        """Get the ids of the books whose presence in a library is known."""
+        if library.id is None:
+            self.get_item(library)
+
+        self._cursor.execute(
+            """
+            SELECT book FROM LibraryBook
+            WHERE library = ? AND present IS NOT NULL
+            """,
+            (library.id,),
+        )
+
+        return {book_id for (book_id,) in self._cursor.fetchall()}
+
+    def get_checked_shop_book_ids(self, shop: Shop) -> Set[int]:
+        """Get the ids of the books whose presence in a shop is known."""
+        if shop.id is None:
+            self.get_item(shop)
+
+        self._cursor.execute(
+            """
+            SELECT book FROM ShopBook
+            WHERE shop = ? AND present IS NOT NULL
+            """,
+            (shop.id,),
+        )
+
+        return {book_id for (book_id,) in self._cursor.fetchall()}
+
     def add_book_tags(self, book: Book, tags: Iterable[str]):
         if book.id is None:
             self.get_item(book)
@@ -719,7 +1635,7 @@ class Database:
                 (book.id, tag_id),
             )
 
-        self._connection.commit()
+        self._commit()
 
     def get_book_tags(self, book: Book):
         if book.id is None:
@@ -738,6 +1654,151 @@ class Database:
 
         return [tag_name for (tag_name,) in self._cursor.fetchall()]
 
+    def get_tag_counts(self) -> List[Tuple[str, int]]:
+        """Get the name of each tag, and the number of books with it, most used first."""
+        self._cursor.execute(
+            """
+            SELECT Tag.name, COUNT(BookTag.book) AS count
+            FROM Tag
+            LEFT JOIN BookTag ON (BookTag.tag = Tag.id)
+            GROUP BY Tag.id
+            ORDER BY count DESC, Tag.name
+            """
+        )
+        return self._cursor.fetchall()
+
+    def get_book_summaries(
+        self,
+        read: Optional[bool] = None,
+        in_library: Optional[bool] = None,
+        max_price: Optional[float] = None,
+    ) -> List[BookSummary]:
+        """Get the summaries of the books matching the conditions, cheapest first.
+
+        The conditions are answered from the BookSummary table alone, using its
+        index, e.g. the unread books in a library for less than 5:
+        get_book_summaries(read=False, in_library=True, max_price=5).
+
+        :param max_price: Maximum lowest price in any shop. Books that aren't
+        in any shop are excluded.
+        """
+        conditions = []
+        params = []
+        if read is not None:
+            conditions.append("read = ?")
+            params.append(read)
+        if in_library is not None:
+            conditions.append("in_library = ?")
+            params.append(in_library)
+        if max_price is not None:
+            conditions.append("min_price <= ?")
+            params.append(max_price)
+
+        query = "SELECT book, read, in_library, min_price, tag_count, challenges FROM BookSummary"
+        if conditions:
+            query += "\nWHERE " + "\nAND ".join(conditions)
+        query += "\nORDER BY min_price, book"
+
+        self._cursor.execute(query, params)
+        return [
+            BookSummary(
+                book,
+                bool(read),
+                bool(in_library),
+                min_price,
+                tag_count,
+                [int(challenge) for challenge in challenges.split(",")] if challenges else [],
+            )
+            for book, read, in_library, min_price, tag_count, challenges in self._cursor.fetchall()
+        ]
+
+    def search(self, text: str, limit: Optional[int] = 20, columns: Iterable[str] = ()) -> List[int]:
+        """Find books by the words in their title, authors and tags.
+
+        Every word in the text must be in the book, or be the start of a word
+        in it, so "hobb tolk" finds The Hobbit by J. R. R. Tolkien. Case and
+        accents are ignored.
+
+        :param limit: Maximum number of books to return, or None for all of them.
+        :param columns: Only search these of "title", "authors" and "tags".
+        :return: The ids of the matching books, best match first. Matches in
+        the title rank above matches in the authors, then the tags.
+        """
+        query = search_query(text, columns)
+        if query is None:
+            return []
+
+        self._cursor.execute(
+            """
+            SELECT rowid FROM BookSearch
+            WHERE BookSearch MATCH ?
+            ORDER BY bm25(BookSearch, 10.0, 5.0, 1.0)
+            LIMIT ?
+            """,
+            (query, -1 if limit is None else limit),
+        )
+
+        return [book_id for (book_id,) in self._cursor.fetchall()]
+
+    def books_with_tags(
+        self,
+        all_of: Iterable[str] = (),
+        any_of: Iterable[str] = (),
+        none_of: Iterable[str] = (),
+    ) -> Set[int]:
+        """Find books by their tags.
+
+        :return: The ids of the books that have all the tags in all_of, at least
+        one of the tags in any_of (if any are given), and none of the tags in
+        none_of.
+        """
+        conditions, params = self._tag_conditions(all_of, any_of, none_of)
+
+        query = "SELECT id FROM Book"
+        if conditions:
+            query += "\nWHERE " + "\nAND ".join(conditions)
+
+        self._cursor.execute(query, params)
+
+        return {book_id for (book_id,) in self._cursor.fetchall()}
+
+    @staticmethod
+    def _tag_conditions(
+        all_of: Iterable[str] = (),
+        any_of: Iterable[str] = (),
+        none_of: Iterable[str] = (),
+    ) -> Tuple[List[str], list]:
+        """Convert conditions on the tags of books to SQL conditions on Book.id."""
+        all_of = set(all_of)
+        any_of = set(any_of)
+        none_of = set(none_of)
+
+        def tagged_books(tags):
+            return (
+                "SELECT BookTag.book FROM BookTag\n"
+                "INNER JOIN Tag ON (BookTag.tag = Tag.id)\n"
+                f"WHERE Tag.name IN ({', '.join('?' * len(tags))})"
+            )
+
+        conditions = []
+        params = []
+
+        if all_of:
+            conditions.append(
+                f"Book.id IN ({tagged_books(all_of)}\n"
+                "GROUP BY BookTag.book HAVING COUNT(DISTINCT BookTag.tag) = ?)"
+            )
+            params.extend(all_of)
+            params.append(len(all_of))
+        if any_of:
+            conditions.append(f"Book.id IN ({tagged_books(any_of)})")
+            params.extend(any_of)
+        if none_of:
+            conditions.append(f"Book.id NOT IN ({tagged_books(none_of)})")
+            params.extend(none_of)
+
+        return conditions, params
+
     def get_book_challenges(self, book: Book) -> Iterable[Challenge]:
         if book.id is None:
             self.get_item(book)
@@ -755,6 +1816,40 @@ class Database:
 
         return [Challenge(name, id_) for (id_, name) in self._cursor.fetchall()]
 
+    def get_challenge_book_ids(self, challenge: Challenge) -> Set[int]:
+        if challenge.id is None:
+            self.get_item(challenge)
+
+        self._cursor.execute(
+            """SELECT book FROM ChallengeBook WHERE challenge = ?""",
+            (challenge.id,),
+        )
+
+        return {book_id for (book_id,) in self._cursor.fetchall()}
+
+    def add_books_to_challenge(self, challenge: Challenge, book_ids: Iterable[int]):
+        if challenge.id is None:
+            self.get_item(challenge)
+
+        self._cursor.executemany(
+            """
+            INSERT INTO ChallengeBook (challenge, book)
+            VALUES (?, ?)
+            """,
+            ((challenge.id, book_id) for book_id in book_ids),
+        )
+        self._commit()
+
+    def remove_books_from_challenge(self, challenge: Challenge, book_ids: Iterable[int]):
+        if challenge.id is None:
+            self.get_item(challenge)
+
+        self._cursor.executemany(
+            """DELETE FROM ChallengeBook WHERE challenge = ? AND book = ?""",
+            ((challenge.id, book_id) for book_id in book_ids),
+        )
+        self._commit()
+
     def challenge_exists(self, challenge: Challenge) -> bool:
         self._cursor.execute(
             """
@@ -764,6 +1859,38 @@ class Database:
         )
         return len(self._cursor.fetchall()) > 0
 
+    def get_search_results(self, source: str, max_age_days: Optional[float] = None) -> Dict[str, Any]:
+        """Get the results of the searches previously made on a source, by query.
+
+        :param max_age_days: Only get results searched for within this many
+        days. All are returned if it's None.
+        """
+        if max_age_days is None:
+            self._cursor.execute(
+                """SELECT query, result FROM SearchResult WHERE source = ?""",
+                (source,),
+            )
+        else:
+            self._cursor.execute(
+                """
+                SELECT query, result FROM SearchResult
+                WHERE source = ? AND searched_at >= datetime('now', ?)
+                """,
+                (source, f"-{max_age_days} days"),
+            )
+
+        return {query: json.loads(result) for query, result in self._cursor.fetchall()}
+
+    def add_search_results(self, source: str, results: Dict[str, Any]):
+        self._cursor.executemany(
+            """
+            INSERT OR REPLACE INTO SearchResult (source, query, result)
+            VALUES (?, ?, ?)
+            """,
+            ((source, query, json.dumps(result)) for query, result in results.items()),
+        )
+        self._commit()
+
     def clear_library_books(self, library: LibrarySystem):
         if library.id is None:
             self.get_item(library)
@@ -772,6 +1899,7 @@ class Database:
             """DELETE FROM LibraryBook WHERE library = ?""",
             (library.id,),
         )
+        self._commit()
 
     def clear_shop_books(self, shop: Shop):
         if shop.id is None:
@@ -781,8 +1909,26 @@ class Database:
             """DELETE FROM ShopBook WHERE shop = ?""",
             (shop.id,),
         )
+        self._commit()
+
+    def add_book_in_shop(
+        self,
+        shop: Shop,
+        book: Book,
+        present: Optional[bool],
+        price: Optional[float],
+        shipping: Optional[float] = None,
+        offer_count: Optional[int] = None,
+        observed: bool = True,
+    ):
+        """Record whether a book is in a shop. present is None if it's unknown.
 
-    def add_book_in_shop(self, shop: Shop, book: Book, present: bool, price: Optional[float]):
+        price is the price of the cheapest offer, including shipping, and
+        offer_count is the number of offers compared. If the price or shipping
+        has changed since it was last recorded, it's added to the book's price
+        history. observed is False if the price was remembered from an earlier
+        search, rather than seen now, so it isn't added to the history.
+        """
         # get ids
         if shop.id is None:
             self.get_item(shop)
@@ -803,27 +1949,163 @@ class Database:
             self._cursor.execute(
                 """
                 UPDATE ShopBook 
-                SET present = ?, price = ?
+                SET present = ?, price = ?, offer_count = ?
                 WHERE shop = ? AND book = ?
                 """,
-                (present, price, shop.id, book.id),
+                (present, price, offer_count, shop.id, book.id),
             )
-            self._connection.commit()
+            if observed:
+                self._add_shop_price(shop, book, present, price, shipping)
+            self._commit()
             return
 
         # add row
         self._cursor.execute(
             """
-            INSERT INTO ShopBook (shop, book, present, price)
-            VALUES (?, ?, ?, ?)
+            INSERT INTO ShopBook (shop, book, present, price, offer_count)
+            VALUES (?, ?, ?, ?, ?)
             """,
-            (shop.id, book.id, present, price),
+            (shop.id, book.id, present, price, offer_count),
         )
-        self._connection.commit()
+        if observed:
+            self._add_shop_price(shop, book, present, price, shipping)
+        self._commit()
+
+    def _add_shop_price(
+        self,
+        shop: Shop,
+        book: Book,
+        present: Optional[bool],
+        price: Optional[float],
+        shipping: Optional[float],
+    ):
+        if present is None:
+            # the search failed, so the price is unknown
+            return
 
+        # only add a row if the price differs from the latest one. Rows copied
+        # from ShopBook by the migration have no shipping, so only their price
+        # is compared.
+        self._cursor.execute(
+            """
+            INSERT INTO ShopPrice (shop, book, price, shipping)
+            SELECT ?, ?, ?, ?
+            WHERE NOT EXISTS (
+                SELECT * FROM (
+                    SELECT price, shipping FROM ShopPrice
+                    WHERE shop = ? AND book = ?
+                    ORDER BY observed_at DESC, id DESC
+                    LIMIT 1
+                )
+                WHERE price IS ? AND (shipping IS ? OR shipping IS NULL)
+            )
+            """,
+            (shop.id, book.id, price, shipping, shop.id, book.id, price, shipping),
+        )
+
+    def get_price_history(self, shop: Shop, book: Book) -> List[Tuple[Optional[float], Optional[float], str]]:
+        """Get each (price, shipping, observed_at) recorded for a book, oldest first.
+
+        The price is None when the book wasn't in the shop.
+        """
+        if shop.id is None:
+            self.get_item(shop)
+        if book.id is None:
+            self.get_item(book)
+
+        self._cursor.execute(
+            """
+            SELECT price, shipping, observed_at FROM ShopPrice
+            WHERE book = ? AND shop = ?
+            ORDER BY observed_at, id
+            """,
+            (book.id, shop.id),
+        )
+        return self._cursor.fetchall()
+
+    def get_price_summaries(self, shop: Shop, below: Optional[float] = None) -> List[PriceSummary]:
+        """Summarise the price history of every book in a shop, in one pass.
+
+        :param below: Only include books whose latest price is below this.
+        """
+        if shop.id is None:
+            self.get_item(shop)
+
+        query = """
+            SELECT book, latest, minimum, first, changes, observed_at FROM (
+                SELECT
+                    book,
+                    last_value(price) OVER history AS latest,
+                    min(price) OVER history AS minimum,
+                    first_value(price) OVER history AS first,
+                    count(*) OVER history AS changes,
+                    last_value(observed_at) OVER history AS observed_at,
+                    row_number() OVER history AS n
+                FROM ShopPrice
+                WHERE shop = ?
+                WINDOW history AS (
+                    PARTITION BY book ORDER BY observed_at, id
+                    ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING
+                )
+            )
+            WHERE n = 1
+        """
+        params = [shop.id]
+
+        if below is not None:
+            query += " AND latest < ?"
+            params.append(below)
+
+        self._cursor.execute(query, params)
+        return [PriceSummary(*row) for row in self._cursor.fetchall()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        "database",
+        description="Print the books in a database."
+    )
+    parser.add_argument(
+        "-d",
+        "--database",
+        type=str,
+        default="database.db",
+        help="Path to database to print.",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print a summary of the database queries made on exit.",
+    )
+    parser.add_argument(
+        "--export",
+        type=str,
+        help="Export the catalogue to this file, instead of printing it.",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["parquet", "npz"],
+        default="parquet",
+        help="Format of the exported file.",
+    )
+    parser.add_argument(
+        "--table",
+        choices=EXPORT_TABLES,
+        default="books",
+        help="Table to export: a row for each book, or for each of their tags, or each library and shop they've been checked in.",
+    )
+
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        query_profiler.enable()
+
+    database = Database(args.database)
+
+    if args.export:
+        database.export_columnar(args.export, args.format, table=args.table)
+        return
 
-def main():
-    database = Database("database.db")
     for book in database.get_books():
         print(book, database.get_book_tags(book))
 
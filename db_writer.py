@@ -0,0 +1,128 @@
+"""Write results to the database from a dedicated thread.
+
+The async checkers push their results to a DatabaseWriter instead of writing to
+the database themselves, so the event loop never waits for sqlite. The writer
+thread applies the results in batched transactions. If it falls behind, the
+checkers wait for space in the queue, rather than the queue growing without
+limit.
+"""
+import asyncio
+import queue
+import threading
+from typing import Optional
+
+from database import Book, Database, LibrarySystem, Shop
+from telemetry import metrics
+
+
+class DatabaseWriter:
+    """Applies writes to the database in a separate thread.
+
+    Use as an async context manager. The remaining writes are flushed when the
+    block exits:
+
+        async with DatabaseWriter(path) as writer:
+            await writer.add_library_book(library, book, True)
+    """
+
+    def __init__(self, path: str, batch_size: int = 100, max_pending: int = 1000):
+        self.path = path
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self._queue: "queue.SimpleQueue" = queue.SimpleQueue()
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None
+
+    async def __aenter__(self) -> "DatabaseWriter":
+        self._loop = asyncio.get_running_loop()
+        self._slots = asyncio.Semaphore(self.max_pending)
+        self._thread = threading.Thread(target=self._run, name="database-writer", daemon=True)
+        self._thread.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def add_library_book(self, library: LibrarySystem, book: Book, present: Optional[bool]):
+        await self._put(("add_library_book", (library, book, present)))
+
+    async def add_book_in_shop(
+        self,
+        shop: Shop,
+        book: Book,
+        present: Optional[bool],
+        price: Optional[float],
+        shipping: Optional[float] = None,
+        offer_count: Optional[int] = None,
+        observed: bool = True,
+    ):
+        await self._put(("add_book_in_shop", (shop, book, present, price, shipping, offer_count, observed)))
+
+    async def _put(self, item):
+        if self._error is not None:
+            raise self._error
+
+        # wait for space, if the writer has fallen behind
+        await self._slots.acquire()
+        if self._error is not None:
+            # the writer failed while this was waiting
+            self._slots.release()
+            raise self._error
+
+        self._queue.put(item)
+
+    def put_threadsafe(self, method: str, *args):
+        """Queue a write from another thread, waiting for space if necessary."""
+        asyncio.run_coroutine_threadsafe(self._put((method, args)), self._loop).result()
+
+    async def close(self):
+        """Write the remaining results, and stop the thread."""
+        if self._thread is None:
+            return
+
+        self._queue.put(None)
+        await asyncio.to_thread(self._thread.join)
+        self._thread = None
+
+        if self._error is not None:
+            raise self._error
+
+    def _release(self, count: int):
+        for _ in range(count):
+            self._slots.release()
+
+    def _run(self):
+        # sqlite connections can't be shared between threads, so open another
+        try:
+            database = Database(self.path)
+        except Exception as e:
+            # keep taking items from the queue, so the waiting producers are
+            # released, and see the error
+            self._error = e
+            database = None
+
+        done = False
+        while not done:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if batch[-1] is None:
+                done = True
+                batch.pop()
+
+            if self._error is None and batch:
+                try:
+                    with metrics.time("database", "db_write"), database.transaction():
+                        for method, args in batch:
+                            getattr(database, method)(*args)
+                except Exception as e:
+                    # stop writing, and raise the error in the event loop
+                    self._error = e
+
+            self._loop.call_soon_threadsafe(self._release, len(batch))
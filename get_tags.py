@@ -1,66 +1,133 @@
 import argparse
 import asyncio
+from typing import List, Tuple
 
 import aiohttp
 from bs4 import BeautifulSoup
 
 from database import Database, Book
+from http_client import CoalescingSearch, fetch
+import query_profiler
+from telemetry import metrics
 
+HOST = "app.thestorygraph.com"
+SEARCH_URL = "https://app.thestorygraph.com/browse"
+searches = CoalescingSearch(HOST)
 
-async def process_book(
-    book: Book,
+
+def save_tags(database: Database, results: List[Tuple[Book, List[str]]]):
+    """Write the tags of a batch of books in a single transaction."""
+    with metrics.time(HOST, "db_write"), database.transaction():
+        for book, tags in results:
+            database.add_book_tags(book, tags)
+
+        database.set_tags_searched([book for book, _ in results])
+
+
+async def harvest_tags(
+    books: List[Book],
     database: Database,
     session: aiohttp.ClientSession,
-):
-    tags = await get_tags(book, session)
+    concurrency: int = 10,
+    batch_size: int = 50,
+) -> List[Book]:
+    """Search for the tags of each book, and save them to the database.
+
+    At most `concurrency` searches are made at once, and results are written in
+    batches of `batch_size` books. A failed search doesn't affect the other books.
+
+    :return: The books whose search failed.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    results = []
+    failed = []
+
+    async def search(book: Book):
+        async with semaphore:
+            try:
+                tags = await get_tags(book, session)
+            except Exception as e:
+                print(book.title, "failed:", repr(e))
+                metrics.increment(HOST, "failures")
+                failed.append(book)
+                return
+
+        print(book.title, tags)
+        metrics.book_done()
+
+        results.append((book, tags))
+        if len(results) >= batch_size:
+            save_tags(database, results)
+            results.clear()
+
+    await asyncio.gather(*(search(book) for book in books))
+
+    # save the last partial batch
+    save_tags(database, results)
+
+    return failed
+
+
+async def get_tags(book: Book, session: aiohttp.ClientSession) -> List[str]:
+    """Search StoryGraph for the tags of a book.
+
+    :return: The book's tags, or an empty list if the book wasn't found.
+    :raises FetchFailed: If the search failed.
+    """
+    url = SEARCH_URL
+    search_term = book.title.lower().strip()
+    params = {
+        "search_term": search_term,
+    }
 
-    database.add_book_tags(book, tags)
+    async def search():
+        _, content = await fetch(session, url, params)
 
-    book.tags_searched = True
-    database.update_book(book)
+        with metrics.time(HOST, "parse"):
+            return parse_tags(content)
 
-    print(book.title, tags)
+    # books with the same title share the search
+    return await searches(search_term, search)
 
-    return tags
 
+def parse_tags(content: bytes) -> List[str]:
+    """Find the tags of the first book in the search results."""
+    soup = BeautifulSoup(content, "html.parser")
 
-async def get_tags(book: Book, session: aiohttp.ClientSession):
-    url = "https://app.thestorygraph.com/browse"
-    params = {
-        "search_term": book.title,
-    }
-
-    async with session.get(url=url, params=params) as response:
-        content = await response.read()
+    # find tags div
+    results = soup.find(
+        "div",
+        {"class": "search-results-books"}
+    )
+    if results is None:
+        return []
 
-        soup = BeautifulSoup(content, "html.parser")
+    book_div = results.find(
+        "div",
+        {"class": "book-pane"}
+    )
+    if book_div is None:
+        return []
 
-        # find tags div
-        results = soup.find(
-            "div",
-            {"class": "search-results-books"}
-        )
-        book_div = results.find(
-            "div",
-            {"class": "book-pane"}
-        )
-        tags_div = book_div.find(
-            "div",
-            {"class": "book-pane-tag-section"},
-        )
+    tags_div = book_div.find(
+        "div",
+        {"class": "book-pane-tag-section"},
+    )
+    if tags_div is None:
+        return []
 
-        # parse tags text
-        tags = tags_div.text.split("\n")
-        tags = [tag.strip() for tag in tags]
-        tags = [tag for tag in tags if tag != ""]
+    # parse tags text
+    tags = tags_div.text.split("\n")
+    tags = [tag.strip() for tag in tags]
+    tags = [tag for tag in tags if tag != ""]
 
-        return tags
+    return tags
 
 
-async def main():
+async def main(argv=None):
     parser = argparse.ArgumentParser(
-        prog="check_nottingham_libraries",
-        description="Check which books are available in Nottingham libraries.",
+        prog="get_tags",
+        description="Search StoryGraph for the tags of each book.",
     )
     parser.add_argument(
         "-d",
@@ -69,8 +136,47 @@ async def main():
         default="database.db",
         help="Path to database containing books to check.",
     )
+    parser.add_argument(
+        "-n",
+        "--concurrency",
+        type=int,
+        default=10,
+        help="Maximum number of searches to make at once.",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        type=int,
+        default=50,
+        help="Number of books to save to the database in each transaction.",
+    )
+    parser.add_argument(
+        "-r",
+        "--retries",
+        type=int,
+        default=2,
+        help="Number of times to retry books whose search failed.",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        help="Write request metrics to this file, as JSON lines, or Prometheus text if it ends in .prom.",
+    )
+    parser.add_argument(
+        "--progress",
+        action="store_true",
+        help="Show a progress line on stderr.",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print a summary of the database queries made on exit.",
+    )
+
+    args = parser.parse_args(argv)
 
-    args = parser.parse_args()
+    if args.profile:
+        query_profiler.enable()
 
     database = Database(args.database)
 
@@ -79,13 +185,29 @@ async def main():
     # don't search for tags twice
     books = [book for book in books if not book.tags_searched]
 
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        for book in books:
-            task = asyncio.ensure_future(process_book(book, database, session))
-            tasks.append(task)
+    # reuse the results of previous searches
+    searches.memo.update(database.get_search_results(HOST))
+
+    if args.progress:
+        metrics.start_progress(len(books))
 
-        await asyncio.gather(*tasks)
+    async with aiohttp.ClientSession(trace_configs=[metrics.trace_config()]) as session:
+        for attempt in range(args.retries + 1):
+            books = await harvest_tags(
+                books, database, session, args.concurrency, args.batch_size
+            )
+            if not books:
+                break
+
+    database.add_search_results(HOST, searches.new_results)
+
+    if args.metrics:
+        metrics.write(args.metrics)
+
+    if books:
+        print(f"Failed to get tags for {len(books)} books:")
+        for book in books:
+            print(book.title)
 
 
 if __name__ == "__main__":
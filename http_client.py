@@ -0,0 +1,188 @@
+"""HTTP requests shared by the async scrapers.
+
+fetch() retries transient failures (connection errors, timeouts, 429 and 5xx
+responses) with jittered exponential backoff. A per-host circuit breaker pauses
+requests to a host after repeated failures, so a struggling site isn't hammered
+with retries. CoalescingSearch makes identical searches share one request.
+"""
+import asyncio
+import random
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import aiohttp
+from yarl import URL
+
+from telemetry import metrics
+
+
+class FetchFailed(Exception):
+    """Raised when a request fails after all retries. The result is unknown."""
+
+
+@dataclass
+class RetryPolicy:
+    max_attempts: int = 4
+    # the delay before the nth retry is a random time up to base_delay * 2 ** n
+    base_delay: float = 0.5
+    max_delay: float = 30.0
+    retry_statuses: Tuple[int, ...] = (429, 500, 502, 503, 504)
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """Pauses requests to a host after repeated consecutive failures.
+
+    After `failure_threshold` failures in a row, requests to the host wait for
+    `pause` seconds. Then one request at a time is let through as a trial, and
+    the others wait for its result. If it succeeds, they all go ahead, and if
+    it fails, they wait for another pause. If the trial's result is never
+    recorded, e.g. because it was cancelled, another trial is let through
+    after `pause` seconds.
+    """
+
+    def __init__(self, failure_threshold: int = 5, pause: float = 60.0):
+        self.failure_threshold = failure_threshold
+        self.pause = pause
+        self._failures: Dict[str, int] = defaultdict(int)
+        self._open_until: Dict[str, float] = {}
+        # set when the result of the host's trial request is recorded
+        self._trials: Dict[str, asyncio.Event] = {}
+
+    async def wait(self, host: str):
+        while True:
+            open_until = self._open_until.get(host)
+            if open_until is None:
+                return
+
+            remaining = open_until - time.monotonic()
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+                continue
+
+            trial = self._trials.get(host)
+            if trial is None:
+                # this request is the trial
+                self._trials[host] = asyncio.Event()
+                return
+
+            try:
+                await asyncio.wait_for(trial.wait(), self.pause)
+            except asyncio.TimeoutError:
+                if self._trials.get(host) is trial:
+                    del self._trials[host]
+
+    def record_success(self, host: str):
+        self._failures[host] = 0
+        self._open_until.pop(host, None)
+        self._end_trial(host)
+
+    def record_failure(self, host: str):
+        self._failures[host] += 1
+        if self._failures[host] >= self.failure_threshold:
+            if host not in self._open_until or self._open_until[host] <= time.monotonic():
+                metrics.increment(host, "circuit_opened")
+            self._open_until[host] = time.monotonic() + self.pause
+        self._end_trial(host)
+
+    def _end_trial(self, host: str):
+        trial = self._trials.pop(host, None)
+        if trial is not None:
+            trial.set()
+
+
+default_policy = RetryPolicy()
+circuit_breaker = CircuitBreaker()
+
+
+async def fetch(
+    session: aiohttp.ClientSession,
+    url: str,
+    params: Optional[dict] = None,
+    policy: RetryPolicy = default_policy,
+    breaker: CircuitBreaker = circuit_breaker,
+) -> Tuple[URL, bytes]:
+    """Make a GET request, retrying transient failures.
+
+    :return: The URL of the response, after redirects, and its content.
+    :raises FetchFailed: If every attempt failed, or the response was a
+    client error that won't succeed on a retry.
+    """
+    host = URL(url).host
+    error = None
+
+    for attempt in range(policy.max_attempts):
+        if attempt > 0:
+            metrics.increment(host, "retries")
+            await asyncio.sleep(policy.delay(attempt - 1))
+
+        await breaker.wait(host)
+
+        try:
+            async with session.get(url=url, params=params) as response:
+                if response.status in policy.retry_statuses:
+                    error = f"HTTP {response.status}"
+                    breaker.record_failure(host)
+                    continue
+
+                if response.status >= 400:
+                    # the host is responding, even if the request is wrong
+                    breaker.record_success(host)
+                    raise FetchFailed(f"HTTP {response.status} from {response.url}")
+
+                content = await response.read()
+                breaker.record_success(host)
+                return response.url, content
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = repr(e)
+            breaker.record_failure(host)
+
+    metrics.increment(host, "failures")
+    raise FetchFailed(f"{url} failed after {policy.max_attempts} attempts: {error}")
+
+
+class CoalescingSearch:
+    """Shares searches for the same query.
+
+    Concurrent calls with the same key share a single search, and its result.
+    Results are also kept in `memo`, which can be loaded from the database, so
+    queries resolved in a previous run aren't searched again. Results must be
+    JSON serialisable, so they can be saved.
+    """
+
+    def __init__(self, host: str):
+        self.host = host
+        self.memo: Dict[str, Any] = {}
+        # results found in this run, which haven't been saved yet
+        self.new_results: Dict[str, Any] = {}
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+    async def __call__(self, key: str, search: Callable[[], Awaitable[Any]]) -> Any:
+        if key in self.memo:
+            metrics.increment(self.host, "cache_hits")
+            return self.memo[key]
+
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(search())
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            metrics.increment(self.host, "coalesced")
+
+        result = await future
+
+        self.memo[key] = result
+        self.new_results[key] = result
+
+        return result
+
+    def is_new(self, key: str) -> bool:
+        """Whether the key's result was found in this run, rather than loaded
+        from the database."""
+        return key in self.new_results
@@ -1,14 +1,24 @@
 import argparse
 import urllib
+from typing import Optional, Set
 from urllib.parse import urlparse
 
 import requests
 from bs4 import BeautifulSoup
 
-from database import Database, Book, Challenge, NotFound
+from database import Database, Book, Challenge
+import query_profiler
+from telemetry import metrics
+
+HOST = "app.thestorygraph.com"
 
 
 def iter_challenge_pages(challenge_id):
+    """Get each page of a challenge, until the caller stops.
+
+    :raises requests.HTTPError: If a page couldn't be fetched, e.g. because
+    of rate limiting.
+    """
     page = 1
     while True:
         url = f"https://app.thestorygraph.com/reading_challenges/{challenge_id}"
@@ -17,12 +27,95 @@ def iter_challenge_pages(challenge_id):
             "_": 1724694396276,
         }
         response = requests.get(url, params=params)
-        soup = BeautifulSoup(response.text, "html.parser")
+        metrics.record_request(HOST, response.elapsed.total_seconds(), response.status_code)
+        metrics.add_bytes(HOST, len(response.content))
+        # an error page doesn't list any books, so it would look like the end
+        # of the challenge
+        response.raise_for_status()
+
+        with metrics.time(HOST, "parse"):
+            soup = BeautifulSoup(response.text, "html.parser")
         yield soup
         page += 1
 
 
-def main():
+class ChallengeImport:
+    """Imports the books of one StoryGraph challenge into the database.
+
+    The challenge is resolved once, and the scraped books are compared against
+    the existing ChallengeBook rows when the import is finished, so only the
+    memberships that have changed are written.
+    """
+
+    def __init__(self, database: Database):
+        self.database = database
+        self.challenge: Optional[Challenge] = None
+        self.existing_book_ids: Set[int] = set()
+        self.book_ids: Set[int] = set()
+        self.titles: Set[str] = set()
+
+    def add_page(self, soup: BeautifulSoup) -> bool:
+        """Add the books listed on a page of the challenge.
+
+        :return: False if the page doesn't contain any books that haven't been
+        seen already, meaning the end of the challenge has been reached.
+        """
+        if self.challenge is None:
+            self._resolve_challenge(soup)
+
+        new_titles = False
+        for link in soup.find_all("a"):
+            if not link.attrs.get("href", "").startswith("/books"):
+                continue
+
+            # get title
+            lines = [line for line in link.text.split("\n") if line]
+            if not lines:
+                continue
+            book_title = lines[0]
+
+            if book_title in self.titles:
+                continue
+            self.titles.add(book_title)
+            new_titles = True
+
+            # search for book
+            book = Book(title=book_title)
+            if self.database.get_book(book):
+                self.book_ids.add(book.id)
+
+        return new_titles
+
+    def finish(self, complete: bool = True):
+        """Write the membership changes to the database.
+
+        :param complete: Whether every page of the challenge was added. If
+        not, books that weren't seen may be on the missing pages, so they
+        aren't removed.
+        """
+        if self.challenge is None:
+            return
+
+        added = self.book_ids - self.existing_book_ids
+        removed = self.existing_book_ids - self.book_ids if complete else set()
+
+        with metrics.time(HOST, "db_write"):
+            if added:
+                self.database.add_books_to_challenge(self.challenge, added)
+            if removed:
+                self.database.remove_books_from_challenge(self.challenge, removed)
+
+        print(f"{self.challenge.name}: {len(added)} added, {len(removed)} removed")
+
+    def _resolve_challenge(self, soup: BeautifulSoup):
+        title = soup.find("h5")
+
+        self.challenge = Challenge(title.text)
+        self.database.add_challenge(self.challenge)
+        self.existing_book_ids = self.database.get_challenge_book_ids(self.challenge)
+
+
+def main(argv=None):
     parser = argparse.ArgumentParser(
         prog="load_challenge",
         description="Load a StoryGraph book challenge.",
@@ -38,42 +131,41 @@ def main():
         default="database.db",
         help="Path to database containing books to check.",
     )
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        help="Write request metrics to this file, as JSON lines, or Prometheus text if it ends in .prom.",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print a summary of the database queries made on exit.",
+    )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        query_profiler.enable()
 
     database = Database(args.database)
 
     url = urlparse(args.challenge_url)
     challenge_id = url.path.split("/")[-1]
 
-    for soup in iter_challenge_pages(challenge_id):
-        title = soup.find("h5")
-        challenge_name = title.text
-
-        challenge = Challenge(challenge_name)
-        database.add_challenge(challenge)
-
-        book_added = False
-        for link in soup.find_all("a"):
-            if not link.attrs["href"].startswith("/books"):
-                continue
-
-            # get title
-            lines = [line for line in link.text.split("\n") if line]
-            book_title = lines[0]
-
-            # search for book
-            book = Book(title=book_title)
-            if not database.get_book(book):
-                continue
-
-            # add to challenge
-            database.add_book_to_challenge(book, challenge)
+    challenge_import = ChallengeImport(database)
+    try:
+        for soup in iter_challenge_pages(challenge_id):
+            if not challenge_import.add_page(soup):
+                break
+    except requests.RequestException:
+        # keep the books found so far, but don't remove any
+        challenge_import.finish(complete=False)
+        raise
 
-            book_added = True
+    challenge_import.finish()
 
-        if not book_added:
-            break
+    if args.metrics:
+        metrics.write(args.metrics)
 
 
 if __name__ == "__main__":
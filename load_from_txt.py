@@ -1,12 +1,11 @@
 import argparse
 import csv
 
-from isbnlib import isbn_from_words, meta
-
 from database import Database, Book
+import query_profiler
 
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser(
         "load_from_txt",
         description="Load storygraph data into the database."
@@ -23,8 +22,19 @@ def main():
         default="database.db",
         help="Path to database to save to."
     )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print a summary of the database queries made on exit.",
+    )
+
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        query_profiler.enable()
 
-    args = parser.parse_args()
+    # isbnlib is slow to import, so only import it when it's needed
+    from isbnlib import isbn_from_words, meta
 
     database = Database(args.database)
 
@@ -2,9 +2,10 @@ import argparse
 import csv
 
 from database import Database, Book, Author
+import query_profiler
 
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser(
         "load_storygraph",
         description="Load storygraph data into the database."
@@ -21,22 +22,43 @@ def main():
         default="database.db",
         help="Path to database to save to."
     )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print a summary of the database queries made on exit.",
+    )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        query_profiler.enable()
 
     database = Database(args.database)
 
     reader = csv.DictReader(args.storygraph_export_file)
-    for row in reader:
-        book = Book(
+    rows = list(reader)
+    books = [
+        Book(
             row["ISBN/UID"] or None,
             row["Title"],
             read=row["Read Count"] != "0",
             authors=[Author(author.strip()) for author in row["Authors"].split(",")],
         )
+        for row in rows
+    ]
+
+    # look up or add all the authors at once
+    database.resolve_authors(author for book in books for author in book.authors)
 
-        if database.get_book(book):
-            database.update_book(book)
+    for row, book in zip(rows, books):
+        # look up the book with a copy, since get_book overwrites the read
+        # status from the export with the stored one
+        stored = Book(book.isbn, book.title)
+        if database.get_book(stored):
+            stored.read = book.read
+            stored.isbn = book.isbn or stored.isbn
+            database.update_book(stored)
+            book.id = stored.id
         else:
             database.add_book(book)
 
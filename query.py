@@ -0,0 +1,179 @@
+"""Print the books matching some filters, without the GUI.
+
+The filters are compiled into a single query, and the rows are streamed to
+stdout in batches, so large catalogues can be piped into other tools:
+
+    book_tools query --unread --tag fantasy --present-in "Libraries West" -f csv
+    book_tools query --shop "Abe Books" --max-price 5 --sort "Abe Books" -f jsonl
+    book_tools query --unread --in-library --max-price 5
+    book_tools query --search "hobbit tolk"
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+from typing import Iterator, List
+
+from database import BookFilter, Database, LibrarySystem, Shop
+import query_profiler
+
+FORMATS = ["table", "csv", "jsonl"]
+# maximum width of each column in the table format
+MAX_WIDTH = 40
+
+
+def write_csv(header: List[str], batches: Iterator[List[tuple]]):
+    writer = csv.writer(sys.stdout)
+    writer.writerow(header)
+    for rows in batches:
+        writer.writerows(rows)
+
+
+def write_jsonl(header: List[str], batches: Iterator[List[tuple]]):
+    for rows in batches:
+        sys.stdout.write("".join(json.dumps(dict(zip(header, row))) + "\n" for row in rows))
+
+
+def write_table(header: List[str], batches: Iterator[List[tuple]]):
+    def format_value(value) -> str:
+        if value is None:
+            return ""
+        text = str(value)
+        return text if len(text) <= MAX_WIDTH else text[:MAX_WIDTH - 1] + "…"
+
+    widths = None
+    for rows in batches:
+        rows = [[format_value(value) for value in row] for row in rows]
+
+        if widths is None:
+            # size the columns to fit the header and the first batch
+            widths = [
+                max([len(name)] + [len(row[i]) for row in rows])
+                for i, name in enumerate(header)
+            ]
+            print("  ".join(name.ljust(width) for name, width in zip(header, widths)))
+            print("  ".join("-" * width for width in widths))
+
+        for row in rows:
+            print("  ".join(value.ljust(width) for value, width in zip(row, widths)))
+
+
+WRITERS = {"table": write_table, "csv": write_csv, "jsonl": write_jsonl}
+
+
+def column_names(libraries: List[LibrarySystem], shops: List[Shop]) -> List[str]:
+    """The names of the columns in the rows from Database.iter_book_rows."""
+    names = ["id", "title", "read", "tags", "challenges", "authors"]
+    names += [library.name for library in libraries]
+    names += [shop.name for shop in shops]
+    return names
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="query",
+        description="Print the books matching the filters.",
+    )
+    parser.add_argument(
+        "-d",
+        "--database",
+        type=str,
+        default=os.path.join(os.path.dirname(__file__), "database.db"),
+        help="Path to database to query.",
+    )
+    read = parser.add_mutually_exclusive_group()
+    read.add_argument("--read", dest="read", action="store_const", const=True, help="Only books that have been read.")
+    read.add_argument("--unread", dest="read", action="store_const", const=False, help="Only books that haven't been read.")
+    parser.add_argument("-t", "--tag", action="append", default=[], help="Only books with this tag. Can be repeated.")
+    parser.add_argument(
+        "--present-in",
+        action="append",
+        default=[],
+        metavar="LIBRARY",
+        help="Only books present in this library. Can be repeated.",
+    )
+    parser.add_argument(
+        "--in-library",
+        action="store_const",
+        const=True,
+        help="Only books present in at least one library.",
+    )
+    parser.add_argument("--shop", type=str, help="Only books in this shop.")
+    parser.add_argument(
+        "--min-price",
+        type=float,
+        help="Minimum price in the shop, or without --shop, the lowest price in any shop.",
+    )
+    parser.add_argument(
+        "--max-price",
+        type=float,
+        help="Maximum price in the shop, or without --shop, the lowest price in any shop.",
+    )
+    parser.add_argument("-c", "--challenge", type=str, help="Only books in this challenge.")
+    parser.add_argument(
+        "-q",
+        "--search",
+        type=str,
+        help="Only books whose title, authors or tags contain every word, or a word starting with it.",
+    )
+    parser.add_argument("-s", "--sort", type=str, help="Column to sort by. By default, the price in the last shop.")
+    parser.add_argument("--desc", action="store_true", help="Sort in descending order.")
+    parser.add_argument("-n", "--limit", type=int, help="Maximum number of books to print.")
+    parser.add_argument("-f", "--format", choices=FORMATS, default="table", help="Output format.")
+    parser.add_argument("-b", "--batch-size", type=int, default=1000, help="Number of rows to fetch at a time.")
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print a summary of the database queries made on exit.",
+    )
+
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        query_profiler.enable()
+
+    database = Database(args.database)
+    libraries = database.get_libraries()
+    shops = database.get_shops()
+
+    header = column_names(libraries, shops)
+
+    order_by = None
+    if args.sort is not None:
+        if args.sort not in header:
+            parser.error(f"unknown column {args.sort!r}. Columns: {', '.join(header)}")
+        order_by = header.index(args.sort)
+
+    book_filter = BookFilter(
+        read=args.read,
+        tags=args.tag,
+        present_in=args.present_in,
+        in_library=args.in_library,
+        shop=args.shop,
+        min_price=args.min_price,
+        max_price=args.max_price,
+        challenge=args.challenge,
+        search=args.search,
+    )
+    batches = database.iter_book_rows(
+        libraries,
+        shops,
+        args.batch_size,
+        order_by=order_by,
+        descending=args.desc,
+        book_filter=book_filter,
+        limit=args.limit,
+    )
+
+    try:
+        WRITERS[args.format](header, batches)
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # the reader stopped early, e.g. head
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+
+
+if __name__ == "__main__":
+    main()
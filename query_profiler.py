@@ -0,0 +1,236 @@
+"""Opt-in instrumentation of the queries made by Database.
+
+When enabled, each Database opened afterwards has its connection and cursor
+wrapped, and its public methods timed. Statements are attributed to the
+innermost Database method that made them. When disabled, Database uses the
+sqlite3 objects directly, so there is no overhead.
+"""
+import atexit
+import sys
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from functools import wraps
+from inspect import isgenerator
+from typing import Dict, List, Optional, Set
+
+# The active profiler, or None if profiling is disabled.
+profiler: Optional["QueryProfiler"] = None
+
+
+def enable() -> "QueryProfiler":
+    """Profile databases opened from now on, and print a summary on exit."""
+    global profiler
+
+    if profiler is None:
+        profiler = QueryProfiler()
+        atexit.register(profiler.print_summary)
+
+    return profiler
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+@dataclass
+class MethodStats:
+    durations: List[float] = field(default_factory=list)
+    statements: int = 0
+    rows: int = 0
+
+
+class QueryProfiler:
+    def __init__(self):
+        self.stats: Dict[str, MethodStats] = defaultdict(MethodStats)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._explained: Set[str] = set()
+
+    def _current_method(self) -> str:
+        stack = getattr(self._local, "stack", None)
+        return stack[-1] if stack else "<none>"
+
+    def _push(self, method: str):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        self._local.stack.append(method)
+
+    def _pop(self):
+        self._local.stack.pop()
+
+    def instrument(self, database):
+        """Wrap the connection, cursor and public methods of a Database."""
+        connection = database._connection
+        database._connection = ProfilingConnection(connection, self)
+        database._cursor = ProfilingCursor(database._cursor, connection, self)
+
+        for name in dir(type(database)):
+            if name.startswith("_"):
+                continue
+
+            method = getattr(database, name)
+            if callable(method):
+                setattr(database, name, self._wrap_method(f"Database.{name}", method))
+
+    def _wrap_method(self, name: str, method):
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            self._push(name)
+            start = time.perf_counter()
+            try:
+                result = method(*args, **kwargs)
+            finally:
+                self._pop()
+
+            if isgenerator(result):
+                # time each step of the generator, since that is when queries run
+                return self._wrap_generator(name, result, time.perf_counter() - start)
+
+            self._record_call(name, time.perf_counter() - start)
+            return result
+
+        return wrapper
+
+    def _wrap_generator(self, name: str, generator, duration: float):
+        while True:
+            self._push(name)
+            start = time.perf_counter()
+            try:
+                item = next(generator)
+            except StopIteration:
+                break
+            finally:
+                duration += time.perf_counter() - start
+                self._pop()
+
+            yield item
+
+        self._record_call(name, duration)
+
+    def _record_call(self, method: str, duration: float):
+        with self._lock:
+            self.stats[method].durations.append(duration)
+
+    def record_statement(self, connection, sql: str, params=()):
+        method = self._current_method()
+        with self._lock:
+            self.stats[method].statements += 1
+            explain = sql not in self._explained
+            self._explained.add(sql)
+
+        if explain and sql.lstrip().upper().startswith("SELECT"):
+            self._check_plan(connection, method, sql, params)
+
+    def record_rows(self, count: int):
+        method = self._current_method()
+        with self._lock:
+            self.stats[method].rows += count
+
+    def _check_plan(self, connection, method: str, sql: str, params):
+        try:
+            plan = connection.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+        except Exception:
+            return
+
+        for *_, detail in plan:
+            if detail.startswith("SCAN ") and " USING " not in detail and "CONSTANT ROW" not in detail:
+                query = " ".join(sql.split())
+                print(f"query plan warning: {detail} in {method}: {query}", file=sys.stderr)
+
+    def summary(self) -> str:
+        lines = [
+            f"{'method':<40} {'calls':>7} {'total s':>9} {'p50 ms':>8} {'p95 ms':>8} "
+            f"{'p99 ms':>8} {'stmts':>8} {'rows':>9}"
+        ]
+
+        with self._lock:
+            items = sorted(
+                self.stats.items(), key=lambda item: sum(item[1].durations), reverse=True
+            )
+            for method, stats in items:
+                lines.append(
+                    f"{method:<40} {len(stats.durations):>7} {sum(stats.durations):>9.3f} "
+                    f"{percentile(stats.durations, 0.5) * 1000:>8.2f} "
+                    f"{percentile(stats.durations, 0.95) * 1000:>8.2f} "
+                    f"{percentile(stats.durations, 0.99) * 1000:>8.2f} "
+                    f"{stats.statements:>8} {stats.rows:>9}"
+                )
+
+        return "\n".join(lines)
+
+    def print_summary(self):
+        if self.stats:
+            print(self.summary(), file=sys.stderr)
+
+
+class ProfilingCursor:
+    """Wraps a sqlite3 cursor, counting statements and rows returned."""
+
+    def __init__(self, cursor, connection, profiler: QueryProfiler):
+        self._cursor = cursor
+        self._connection = connection
+        self._profiler = profiler
+
+    def execute(self, sql, params=()):
+        self._profiler.record_statement(self._connection, sql, params)
+        self._cursor.execute(sql, params)
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self._profiler.record_statement(self._connection, sql)
+        self._cursor.executemany(sql, seq_of_params)
+        return self
+
+    def executescript(self, script):
+        self._profiler.record_statement(self._connection, script)
+        self._cursor.executescript(script)
+        return self
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._profiler.record_rows(1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._cursor.fetchmany(size) if size is not None else self._cursor.fetchmany()
+        self._profiler.record_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._profiler.record_rows(len(rows))
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._profiler.record_rows(1)
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class ProfilingConnection:
+    """Wraps a sqlite3 connection, so new cursors are profiled."""
+
+    def __init__(self, connection, profiler: QueryProfiler):
+        self._connection = connection
+        self._profiler = profiler
+
+    def cursor(self, *args, **kwargs):
+        return ProfilingCursor(
+            self._connection.cursor(*args, **kwargs), self._connection, self._profiler
+        )
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
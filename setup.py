@@ -8,5 +8,8 @@ setup(
     license='',
     author='charlie',
     author_email='',
-    description=''
+    description='',
+    entry_points={
+        'console_scripts': ['book_tools=cli:main'],
+    },
 )
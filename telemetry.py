@@ -0,0 +1,180 @@
+"""Metrics collected by the scrapers.
+
+Everything is recorded per host in the module level `metrics` object: request
+latencies, bytes downloaded, response statuses, event counters (retries, cache
+hits, ...) and the time spent in each processing stage (parsing, database
+writes). The metrics can be written as JSON lines, or in the Prometheus text
+format if the file name ends in ".prom".
+"""
+import json
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from query_profiler import percentile
+
+
+@dataclass
+class HostMetrics:
+    latencies: List[float] = field(default_factory=list)
+    bytes: int = 0
+    statuses: Counter = field(default_factory=Counter)
+    events: Counter = field(default_factory=Counter)
+    stage_seconds: Dict[str, float] = field(default_factory=lambda: defaultdict(float))
+
+
+class Telemetry:
+    # minimum number of seconds between updates of the progress line
+    progress_interval = 0.5
+
+    def __init__(self):
+        self.hosts: Dict[str, HostMetrics] = defaultdict(HostMetrics)
+        self._lock = threading.Lock()
+
+        self.total: Optional[int] = None
+        self.done = 0
+        self._start = time.perf_counter()
+        self._last_progress = 0.0
+
+    def record_request(self, host: str, latency: float, status: Optional[int]):
+        with self._lock:
+            self.hosts[host].latencies.append(latency)
+            self.hosts[host].statuses[status] += 1
+
+    def add_bytes(self, host: str, size: int):
+        with self._lock:
+            self.hosts[host].bytes += size
+
+    def increment(self, host: str, event: str, count: int = 1):
+        with self._lock:
+            self.hosts[host].events[event] += count
+
+    @contextmanager
+    def time(self, host: str, stage: str):
+        """Time a stage of processing, such as "parse" or "db_write"."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            with self._lock:
+                self.hosts[host].stage_seconds[stage] += duration
+
+    def trace_config(self):
+        """Create an aiohttp TraceConfig that records every request made by a session."""
+        import aiohttp
+
+        async def on_request_start(session, context, params):
+            context.start = time.perf_counter()
+
+        async def on_request_end(session, context, params):
+            latency = time.perf_counter() - context.start
+            self.record_request(params.url.host, latency, params.response.status)
+
+        async def on_request_exception(session, context, params):
+            latency = time.perf_counter() - context.start
+            self.record_request(params.url.host, latency, None)
+
+        async def on_response_chunk_received(session, context, params):
+            self.add_bytes(params.url.host, len(params.chunk))
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_exception)
+        trace_config.on_response_chunk_received.append(on_response_chunk_received)
+
+        return trace_config
+
+    def start_progress(self, total: int):
+        """Show a progress line on stderr, updated each time a book is finished."""
+        self.total = total
+        self.done = 0
+        self._start = time.perf_counter()
+
+    def book_done(self):
+        with self._lock:
+            self.done += 1
+            if self.total is None:
+                return
+
+            now = time.perf_counter()
+            if now - self._last_progress < self.progress_interval and self.done < self.total:
+                return
+            self._last_progress = now
+
+            rate = self.done / max(now - self._start, 1e-9)
+            eta = (self.total - self.done) / rate if rate > 0 else 0.0
+
+        end = "\n" if self.done >= self.total else ""
+        print(
+            f"\r{self.done}/{self.total} books, {rate:.1f} books/s, ETA {eta:.0f}s",
+            end=end,
+            file=sys.stderr,
+            flush=True,
+        )
+
+    def to_json_lines(self) -> str:
+        lines = []
+        with self._lock:
+            for host, host_metrics in sorted(self.hosts.items()):
+                latencies = host_metrics.latencies
+                lines.append(json.dumps({
+                    "host": host,
+                    "requests": len(latencies),
+                    "latency_p50": percentile(latencies, 0.5),
+                    "latency_p95": percentile(latencies, 0.95),
+                    "latency_p99": percentile(latencies, 0.99),
+                    "bytes": host_metrics.bytes,
+                    "statuses": {str(status): count for status, count in host_metrics.statuses.items()},
+                    "events": dict(host_metrics.events),
+                    "stage_seconds": dict(host_metrics.stage_seconds),
+                }))
+
+        return "\n".join(lines) + "\n"
+
+    def to_prometheus(self) -> str:
+        lines = [
+            "# TYPE book_tools_request_latency_seconds summary",
+            "# TYPE book_tools_downloaded_bytes_total counter",
+            "# TYPE book_tools_responses_total counter",
+            "# TYPE book_tools_events_total counter",
+            "# TYPE book_tools_stage_seconds_total counter",
+        ]
+
+        with self._lock:
+            for host, host_metrics in sorted(self.hosts.items()):
+                latencies = host_metrics.latencies
+                for quantile in (0.5, 0.95, 0.99):
+                    lines.append(
+                        f'book_tools_request_latency_seconds{{host="{host}",quantile="{quantile}"}} '
+                        f"{percentile(latencies, quantile)}"
+                    )
+                lines.append(f'book_tools_request_latency_seconds_sum{{host="{host}"}} {sum(latencies)}')
+                lines.append(f'book_tools_request_latency_seconds_count{{host="{host}"}} {len(latencies)}')
+                lines.append(f'book_tools_downloaded_bytes_total{{host="{host}"}} {host_metrics.bytes}')
+
+                for status, count in host_metrics.statuses.items():
+                    lines.append(f'book_tools_responses_total{{host="{host}",status="{status}"}} {count}')
+                for event, count in host_metrics.events.items():
+                    lines.append(f'book_tools_events_total{{host="{host}",event="{event}"}} {count}')
+                for stage, seconds in host_metrics.stage_seconds.items():
+                    lines.append(f'book_tools_stage_seconds_total{{host="{host}",stage="{stage}"}} {seconds}')
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        if path.endswith(".prom"):
+            text = self.to_prometheus()
+        else:
+            text = self.to_json_lines()
+
+        with open(path, "w") as f:
+            f.write(text)
+
+
+metrics = Telemetry()
@@ -0,0 +1,59 @@
+"""Parse AbeBooks search results."""
+from check_libraries.check_abebooks import parse_offers
+
+
+def result_item(title: str, author: str, price: str, shipping: str, book_id: int) -> str:
+    return f"""
+    <li class="cf result-item">
+      <div class="result-detail">
+        <h2 class="title"><a href="/servlet/BookDetailsPL?bi={book_id}"><span>{title}</span></a></h2>
+        <p class="author"><strong>{author}</strong></p>
+      </div>
+      <div class="result-pricing">
+        <p class="item-price">£ {price}</p>
+        <span class="item-shipping">{shipping}</span>
+      </div>
+    </li>"""
+
+
+# a keyword search also finds study guides and other books, some cheaper
+MIXED_RESULTS = f"""<!DOCTYPE html>
+<html><body>
+<div class="result-set">
+  <ul class="result-list">
+    {result_item("The Hobbit", "Tolkien, J. R. R.", "6.50", "£ 2.80 Shipping", 1)}
+    {result_item("York Notes on The Hobbit: A Study Guide", "Martin Gray", "1.20", "FREE Shipping", 2)}
+    {result_item("The Hobbit", "Unknown", "4.00", "£ 3.00 Shipping", 3)}
+    {result_item("The Hobbit", "Jane Smith", "0.99", "£ 1.00 Shipping", 4)}
+    {result_item("The Hobbit", "J.R.R. Tolkien", "5.00", "FREE Shipping", 5)}
+  </ul>
+</div>
+</body></html>""".encode()
+
+
+def test_parse_offers_all():
+    offers = parse_offers(MIXED_RESULTS)
+
+    assert [offer.price for offer in offers] == [1.20, 1.99, 5.00, 7.00, 9.30]
+
+
+def test_parse_offers_filters_other_books():
+    offers = parse_offers(MIXED_RESULTS, title="The Hobbit", author="J.R.R. Tolkien")
+
+    # the study guide and the book by another author are skipped, but the
+    # result without an author isn't
+    assert [offer.link for offer in offers] == [
+        "/servlet/BookDetailsPL?bi=5",
+        "/servlet/BookDetailsPL?bi=3",
+        "/servlet/BookDetailsPL?bi=1",
+    ]
+    assert offers[0].price == 5.00
+    assert offers[0].shipping == 0.0
+    assert offers[1].author is None
+
+
+def test_parse_offers_max_offers():
+    offers = parse_offers(MIXED_RESULTS, max_offers=2, title="The Hobbit")
+
+    assert [offer.link for offer in offers] == ["/servlet/BookDetailsPL?bi=1"]
+
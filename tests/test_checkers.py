@@ -0,0 +1,131 @@
+"""Run the checkers end-to-end against the benchmarks' replay server."""
+import asyncio
+import importlib
+
+import pytest
+
+from benchmarks.generate import generate_database
+from benchmarks.run import start_replay_server
+from database import Database
+from http_client import CoalescingSearch
+
+NUM_BOOKS = 20
+
+# maps each checker to the route serving its search page
+CHECKERS = {
+    "check_libraries.check_abebooks": "/abebooks/servlet/SearchResults",
+    "check_libraries.check_libraries_west": "/librarieswest/search",
+    "check_libraries.check_nottingham_libraries": "/nottingham/search",
+}
+
+
+@pytest.fixture(scope="module")
+def server_url():
+    return start_replay_server(0.0)
+
+
+@pytest.fixture
+def database_path(tmp_path):
+    path = str(tmp_path / "database.db")
+    generate_database(path, NUM_BOOKS, seed=1)
+    return path
+
+
+def checked_book_ids(database: Database, module):
+    if hasattr(module, "shop"):
+        return database.get_checked_shop_book_ids(module.shop)
+    return database.get_checked_library_book_ids(module.library)
+
+
+@pytest.mark.parametrize("module_name", CHECKERS)
+def test_clear(module_name, server_url, database_path, monkeypatch):
+    """--clear deletes the previous results, and every book is checked again."""
+    module = importlib.import_module(module_name)
+    monkeypatch.setattr(module, "SEARCH_URL", server_url + CHECKERS[module_name])
+    monkeypatch.setattr(module, "searches", CoalescingSearch(module.HOST))
+
+    asyncio.run(module.main(["-d", database_path, "--clear"]))
+
+    database = Database(database_path)
+    book_ids = {book.id for book in database.get_books()}
+    assert checked_book_ids(database, module) == book_ids
+
+
+def test_get_tags_rerun(server_url, database_path, monkeypatch):
+    """Books whose tags have been searched for aren't searched again."""
+    import get_tags
+
+    monkeypatch.setattr(get_tags, "SEARCH_URL", server_url + "/storygraph/browse")
+    monkeypatch.setattr(get_tags, "searches", CoalescingSearch(get_tags.HOST))
+
+    searched = []
+    search = get_tags.get_tags
+
+    async def get_tags_counted(book, session):
+        searched.append(book.id)
+        return await search(book, session)
+
+    monkeypatch.setattr(get_tags, "get_tags", get_tags_counted)
+
+    asyncio.run(get_tags.main(["-d", database_path]))
+    assert all(book.tags_searched for book in Database(database_path).get_books())
+
+    searched.clear()
+    asyncio.run(get_tags.main(["-d", database_path]))
+    assert searched == []
+
+
+def count_fetches(module, monkeypatch):
+    fetches = []
+    fetch = module.fetch
+
+    async def fetch_counted(*args, **kwargs):
+        fetches.append(args)
+        return await fetch(*args, **kwargs)
+
+    monkeypatch.setattr(module, "fetch", fetch_counted)
+    return fetches
+
+
+@pytest.mark.parametrize("module_name", CHECKERS)
+def test_clear_searches_again(module_name, server_url, database_path, monkeypatch):
+    """--clear doesn't reuse the saved search results."""
+    module = importlib.import_module(module_name)
+    monkeypatch.setattr(module, "SEARCH_URL", server_url + CHECKERS[module_name])
+    monkeypatch.setattr(module, "searches", CoalescingSearch(module.HOST))
+    # search for every book, and save the results
+    asyncio.run(module.main(["-d", database_path, "--force"]))
+
+    fetches = count_fetches(module, monkeypatch)
+    monkeypatch.setattr(module, "searches", CoalescingSearch(module.HOST))
+    asyncio.run(module.main(["-d", database_path, "--clear"]))
+
+    assert fetches
+
+
+def test_remembered_prices_arent_observed(server_url, database_path, monkeypatch):
+    """Prices from saved search results aren't added to the price history again."""
+    from check_libraries import check_abebooks
+
+    monkeypatch.setattr(check_abebooks, "SEARCH_URL", server_url + CHECKERS[check_abebooks.__name__])
+    monkeypatch.setattr(check_abebooks, "searches", CoalescingSearch(check_abebooks.HOST))
+    # search for every book
+    asyncio.run(check_abebooks.main(["-d", database_path, "--clear"]))
+
+    database = Database(database_path)
+    count = "SELECT COUNT(*) FROM ShopPrice"
+    prices = database._cursor.execute(count).fetchone()[0]
+    assert prices > 0
+
+    # forget which books were checked, but not the search results, and
+    # pretend the prices have changed since
+    database._cursor.execute("DELETE FROM ShopBook")
+    database._cursor.execute("UPDATE ShopPrice SET price = price + 1")
+    database._commit()
+
+    fetches = count_fetches(check_abebooks, monkeypatch)
+    monkeypatch.setattr(check_abebooks, "searches", CoalescingSearch(check_abebooks.HOST))
+    asyncio.run(check_abebooks.main(["-d", database_path]))
+
+    assert fetches == []
+    assert database._cursor.execute(count).fetchone()[0] == prices
@@ -0,0 +1,83 @@
+"""Database queries."""
+import pytest
+
+from benchmarks.generate import generate_database
+from database import Author, Book, BookFilter, Database, Shop
+
+
+def test_price_history_ignores_missing_shipping(tmp_path):
+    database = Database(str(tmp_path / "database.db"))
+    shop = Shop("Abe Books")
+    database.add_shop(shop)
+    book = Book(title="The Hobbit", authors=[Author("J.R.R. Tolkien")])
+    database.add_book(book)
+    database.get_book(book)
+    database.get_item(shop)
+
+    # a price copied from ShopBook by the migration, without shipping
+    database._cursor.execute(
+        "INSERT INTO ShopPrice (shop, book, price) VALUES (?, ?, ?)",
+        (shop.id, book.id, 7.5),
+    )
+    database._commit()
+
+    # recording shipping for the first time isn't a change in price
+    database.add_book_in_shop(shop, book, True, 7.5, 2.5)
+    assert [price for price, _, _ in database.get_price_history(shop, book)] == [7.5]
+
+    database.add_book_in_shop(shop, book, True, 6.0, 2.5)
+    database.add_book_in_shop(shop, book, True, 6.0, 1.0)
+    assert [(price, shipping) for price, shipping, _ in database.get_price_history(shop, book)] == [
+        (7.5, None),
+        (6.0, 2.5),
+        (6.0, 1.0),
+    ]
+
+
+def test_search_results_expire(tmp_path):
+    database = Database(str(tmp_path / "database.db"))
+    database.add_search_results("example.com", {"old": [1], "new": [2]})
+    database._cursor.execute(
+        "UPDATE SearchResult SET searched_at = datetime('now', '-10 days') WHERE query = 'old'"
+    )
+    database._commit()
+
+    assert database.get_search_results("example.com") == {"old": [1], "new": [2]}
+    assert database.get_search_results("example.com", max_age_days=7) == {"new": [2]}
+
+
+def test_export_long_tables(tmp_path):
+    pytest.importorskip("pyarrow")
+    np = pytest.importorskip("numpy")
+
+    path = str(tmp_path / "database.db")
+    generate_database(path, 50, seed=1)
+    database = Database(path)
+
+    tags = database.to_pandas(table="tags")
+    assert list(tags.columns) == ["book", "tag"]
+    assert len(tags) == database._cursor.execute("SELECT COUNT(*) FROM BookTag").fetchone()[0]
+
+    availability = database.to_pandas(table="availability")
+    assert list(availability.columns) == ["book", "source", "present", "price"]
+    assert set(availability["source"]) <= {
+        item.name for item in database.get_libraries() + database.get_shops()
+    }
+
+    database.export_columnar(str(tmp_path / "tags.npz"), "npz", batch_size=7, table="tags")
+    with np.load(str(tmp_path / "tags.npz")) as exported:
+        assert list(exported["book"]) == list(tags["book"])
+        assert list(exported["tag"]) == list(tags["tag"])
+
+
+def test_book_filter_search_columns(tmp_path):
+    database = Database(str(tmp_path / "database.db"))
+    for title, author in (("The Hobbit", "J.R.R. Tolkien"), ("Tolkien: A Biography", "Humphrey Carpenter")):
+        database.add_book(Book(title=title, authors=[Author(author)]))
+
+    def titles(book_filter):
+        rows = database.iter_book_rows([], [], book_filter=book_filter)
+        return sorted(row[1] for batch in rows for row in batch)
+
+    assert titles(BookFilter(search="tolkien")) == ["The Hobbit", "Tolkien: A Biography"]
+    assert titles(BookFilter(search="tolkien", search_columns=["title"])) == ["Tolkien: A Biography"]
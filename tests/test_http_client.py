@@ -0,0 +1,57 @@
+"""The circuit breaker shared by the async scrapers."""
+import asyncio
+
+from http_client import CircuitBreaker
+
+HOST = "example.com"
+
+
+async def start_requests(breaker: CircuitBreaker, passed: list, count: int):
+    async def request(i: int):
+        await breaker.wait(HOST)
+        passed.append(i)
+
+    return [asyncio.ensure_future(request(i)) for i in range(count)]
+
+
+def test_trial_request():
+    async def run():
+        breaker = CircuitBreaker(failure_threshold=1, pause=0.05)
+        breaker.record_failure(HOST)
+
+        passed = []
+        tasks = await start_requests(breaker, passed, 5)
+
+        # only one request is let through after the pause
+        await asyncio.sleep(0.1)
+        assert len(passed) == 1
+
+        # and the others go ahead once it succeeds
+        breaker.record_success(HOST)
+        await asyncio.gather(*tasks)
+        assert len(passed) == 5
+
+    asyncio.run(run())
+
+
+def test_failed_trial():
+    async def run():
+        breaker = CircuitBreaker(failure_threshold=1, pause=0.05)
+        breaker.record_failure(HOST)
+
+        passed = []
+        tasks = await start_requests(breaker, passed, 3)
+        await asyncio.sleep(0.07)
+        assert len(passed) == 1
+
+        # the circuit opens again, and the next trial waits for another pause
+        breaker.record_failure(HOST)
+        await asyncio.sleep(0.02)
+        assert len(passed) == 1
+        await asyncio.sleep(0.06)
+        assert len(passed) == 2
+
+        breaker.record_success(HOST)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
@@ -0,0 +1,60 @@
+"""Import StoryGraph challenges."""
+import datetime
+
+import pytest
+import requests
+
+import load_challenge
+from database import Book, Challenge, Database
+
+
+def challenge_page(status_code: int, titles) -> requests.Response:
+    links = "".join(f'<a href="/books/{i}">{title}</a>' for i, title in enumerate(titles))
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = f"<h5>Classics</h5>{links}".encode()
+    response.elapsed = datetime.timedelta()
+    response.url = "https://app.thestorygraph.com/reading_challenges/1"
+    return response
+
+
+@pytest.fixture
+def database_path(tmp_path):
+    path = str(tmp_path / "database.db")
+    database = Database(path)
+    books = [Book(title=title) for title in ("Emma", "Middlemarch", "Dracula")]
+    for book in books:
+        database.add_book(book)
+
+    # Dracula was in the challenge before the import
+    challenge = Challenge("Classics")
+    database.add_challenge(challenge)
+    database.add_books_to_challenge(challenge, [books[2].id])
+    return path
+
+
+def challenge_titles(path):
+    database = Database(path)
+    book_ids = database.get_challenge_book_ids(Challenge("Classics"))
+    return {book.title for book in database.get_books() if book.id in book_ids}
+
+
+def run(path, pages, monkeypatch):
+    pages = iter(pages)
+    monkeypatch.setattr(load_challenge.requests, "get", lambda url, params: next(pages))
+    load_challenge.main(["https://app.thestorygraph.com/reading_challenges/1", "-d", path])
+
+
+def test_books_not_listed_are_removed(database_path, monkeypatch):
+    run(database_path, [challenge_page(200, ["Emma", "Middlemarch"]), challenge_page(200, [])], monkeypatch)
+
+    assert challenge_titles(database_path) == {"Emma", "Middlemarch"}
+
+
+def test_error_page_doesnt_remove_books(database_path, monkeypatch):
+    pages = [challenge_page(200, ["Emma"]), challenge_page(429, [])]
+    with pytest.raises(requests.HTTPError):
+        run(database_path, pages, monkeypatch)
+
+    # Dracula may be on the page that wasn't fetched
+    assert challenge_titles(database_path) == {"Emma", "Dracula"}
@@ -1,123 +1,313 @@
 import argparse
+from collections import defaultdict
 from copy import deepcopy
+from itertools import islice
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
 
 import PySimpleGUI as sg
-from Levenshtein import distance
 
-from database import Database
+from database import BookFilter, Database
+import query_profiler
+
+
+# Number of rows loaded from the database, and added to the table widget, at a time.
+PAGE_SIZE = 200
+
+# Load more rows when the table is scrolled past this fraction of its height.
+SCROLL_THRESHOLD = 0.9
+
+# Columns filtered by the database's query, so filtering them doesn't load the
+# whole catalogue. The other columns are filtered in memory.
+DATABASE_FILTER_COLUMNS = ("Title", "Tags")
 
 
 class FilterTable(sg.Table):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    """Table of books, loaded from the database and rendered one page at a time.
+
+    :param query_rows: Function taking the index of the column to sort by (or
+    None for the default order), whether to sort in descending order, and a
+    BookFilter, and returning an iterator over the rows of the matching
+    books. Rows are only taken from the iterator as they are needed.
+    """
+
+    def __init__(
+        self,
+        query_rows: Callable[[Optional[int], bool, BookFilter], Iterator[list]],
+        *args,
+        **kwargs,
+    ):
+        super().__init__([], *args, **kwargs)
         self.filters = [None] * len(self.ColumnHeadings)
-        self.original_values = self.Values.copy()
 
-    def filter(self, col: int):
-        # prompt user for desired value
-        column_name = self.ColumnHeadings[col]
-        value = sg.popup_get_text(
-            f"Filter {column_name}: ",
-            default_text=self.filters[col] or "",
+        # rows matching the filter on each column, or None if the column isn't filtered
+        self._column_matches: List[Optional[Set[int]]] = [None] * len(self.ColumnHeadings)
+
+        # rows of original_values being shown, or None if all of them are shown
+        self._visible_rows: Optional[List[int]] = None
+
+        self._query_rows = query_rows
+        # the column to sort by, and whether the order is descending
+        self._order: Tuple[Optional[int], bool] = (None, False)
+        self._reset_rows()
+
+        # the widget hasn't been created yet, so set the initial values directly
+        self.Values = self.original_values[:PAGE_SIZE]
+
+    def _reset_rows(self):
+        """Start loading the rows matching the database filters from the
+        database, in the current order."""
+        self._rows = self._query_rows(*self._order, self._book_filter())
+        self._all_loaded = False
+        self.original_values = []
+
+        # Indexes over original_values, so filters don't have to rescan every row.
+        # Rows are referred to by their index in original_values.
+        # Authors: maps each author to the rows containing them
+        self._author_rows: Dict[str, Set[int]] = defaultdict(set)
+        # other columns: maps column -> value -> rows with that value
+        self._value_rows: Dict[int, Dict[str, Set[int]]] = defaultdict(lambda: defaultdict(set))
+
+        self._load_rows(PAGE_SIZE)
+
+    def _book_filter(self) -> BookFilter:
+        """The filters on DATABASE_FILTER_COLUMNS, to be evaluated by the database."""
+        title = self.filters[self.ColumnHeadings.index("Title")]
+        tags = self.filters[self.ColumnHeadings.index("Tags")]
+
+        return BookFilter(
+            # titles containing every word, or a word starting with it, using
+            # the database's full-text index
+            search=title,
+            search_columns=["title"],
+            tags=tags.split(", ") if tags is not None else [],
         )
 
-        if value is None:
+    def _index_rows(self, start: int):
+        """Add original_values[start:] to the indexes."""
+        authors_col = self.ColumnHeadings.index("Authors")
+        value_cols = [
+            col for col, column in enumerate(self.ColumnHeadings)
+            if column not in ("Title", "Tags", "Authors")
+        ]
+
+        for i in range(start, len(self.original_values)):
+            row = self.original_values[i]
+
+            for author in row[authors_col].split(", "):
+                self._author_rows[author].add(i)
+
+            for col in value_cols:
+                self._value_rows[col][str(row[col])].add(i)
+
+    def _load_rows(self, count: Optional[int] = None):
+        """Load more rows from the database, or all the remaining rows if count is None."""
+        if self._all_loaded:
             return
 
+        start = len(self.original_values)
+        new_rows = list(islice(self._rows, count))
+        if count is None or len(new_rows) < count:
+            self._all_loaded = True
+
+        self.original_values.extend(new_rows)
+
+        self._index_rows(start)
+
+    def watch_scroll(self, window: sg.Window):
+        """Generate a scroll event when the table is scrolled near the bottom.
+
+        Must be called after the window is finalized.
+        """
+        def on_scroll(first, last):
+            self.vsb.set(first, last)
+            if float(last) >= SCROLL_THRESHOLD:
+                window.write_event_value((self.Key, "+SCROLLED+"), None)
+
+        self.TKTreeview.configure(yscrollcommand=on_scroll)
+
+    def _render(self):
+        """Show the first page of the visible rows."""
+        if self._visible_rows is None:
+            rows = self.original_values[:PAGE_SIZE]
+        else:
+            rows = [self.original_values[i] for i in self._visible_rows[:PAGE_SIZE]]
+
+        self.update(values=rows)
+
+    def _render_more(self):
+        """Add the next page of visible rows to the table widget."""
+        start = len(self.Values)
+
+        if self._visible_rows is None:
+            if start + PAGE_SIZE > len(self.original_values):
+                self._load_rows(PAGE_SIZE)
+            rows = self.original_values[start:start + PAGE_SIZE]
+        else:
+            rows = [self.original_values[i] for i in self._visible_rows[start:start + PAGE_SIZE]]
+
+        # Insert the rows directly, instead of calling update, so the rows already
+        # in the widget aren't re-rendered. This follows what sg.Table.update does.
+        self.Values = self.Values + rows
+        for i, row in enumerate(rows, start=start):
+            iid = self.TKTreeview.insert("", "end", text=row, iid=i + 1, values=row, tag=i)
+            self.tree_ids.append(iid)
+
+    def prompt(self, col: int):
+        """Ask the user how to filter or sort a column."""
+        column_name = self.ColumnHeadings[col]
+        layout = [
+            [sg.Text(f"Filter {column_name}: ")],
+            [sg.Input(default_text=self.filters[col] or "", key="-FILTER-")],
+            [
+                sg.Button("Filter", bind_return_key=True),
+                sg.Button("Sort ascending"),
+                sg.Button("Sort descending"),
+                sg.Button("Cancel"),
+            ],
+        ]
+        window = sg.Window(column_name, layout, modal=True)
+        event, values = window.read()
+        window.close()
+
+        if event == "Filter":
+            self.filter(col, values["-FILTER-"])
+        elif event == "Sort ascending":
+            self.sort(col, descending=False)
+        elif event == "Sort descending":
+            self.sort(col, descending=True)
+
+    def filter(self, col: int, value: str):
         # update filters
         self.filters[col] = value
         if self.filters[col] == "":
             # clear filter
             self.filters[col] = None
 
-        self.apply_filters()
+        if self.ColumnHeadings[col] in DATABASE_FILTER_COLUMNS:
+            self._requery()
+            return
 
-    def apply_filters(self):
-        new_table_data = []
-        for row in self.original_values:
-            for column, filtered_value, value in zip(
-                self.ColumnHeadings, self.filters, row
-            ):
-                if filtered_value is None:
-                    continue
-
-                if column in ("Tags", "Authors"):
-                    # check all filter tags are present
-                    row_tags = value.split(", ")
-                    filter_tags = filtered_value.split(", ")
-                    if len(set(filter_tags).difference(row_tags)) > 0:
-                        break
-                    else:
-                        continue
-
-                if column == "Title":
-                    if filtered_value.lower() not in value.lower():
-                        break
-                    else:
-                        continue
-
-                # check filter value is equal to row value
-                if value != filtered_value:
-                    break
-            else:
-                new_table_data.append(row)
-
-        self.update(values=new_table_data)
+        # filters apply to the whole table
+        self._load_rows()
 
-    def process_event(self, event):
-        if event[:2] == (0, "+CLICKED+"):
-            _, _, (row, col) = event
-            if row == -1:
-                self.filter(col)
+        self._column_matches[col] = self._match_column(col)
 
+        self.apply_filters()
 
-def create_table(database: Database):
-    # load from database
-    book_data = []
-    for book in database.get_books():
-        _book_data = [
-            book.title,
-            "yes" if book.read else "no",
-            ", ".join(database.get_book_tags(book)),
-            ", ".join(challenge.name for challenge in database.get_book_challenges(book)),
-            ", ".join(author.name for author in book.authors)
+    def sort(self, col: int, descending: bool = False):
+        """Sort the table by a column. The sorting is done by the database."""
+        # the first column of the rows from the database is the book id
+        self._order = (col + 1, descending)
+        self._requery()
+
+    def _requery(self):
+        """Reload the rows from the database, after the database filters or the
+        order have changed."""
+        self._reset_rows()
+
+        # row numbers have changed, so the other filters must be matched again.
+        # Only they need every matching row to be loaded.
+        self._column_matches = [None] * len(self.ColumnHeadings)
+        memory_filters = [
+            col for col, column in enumerate(self.ColumnHeadings)
+            if column not in DATABASE_FILTER_COLUMNS and self.filters[col] is not None
         ]
-        for library in database.get_libraries():
-            present = database.check_book_in_library(book, library)
+        if memory_filters:
+            self._load_rows()
+            for col in memory_filters:
+                self._column_matches[col] = self._match_column(col)
+
+        self.apply_filters()
 
-            if present is None:
-                value = ""
-            elif present:
-                value = "yes"
-            else:
-                value = "no"
+    def _match_column(self, col: int) -> Optional[Set[int]]:
+        """Find the loaded rows matching the filter on a column that isn't
+        filtered by the database."""
+        value = self.filters[col]
+        if value is None:
+            return None
 
-            _book_data.append(value)
+        column = self.ColumnHeadings[col]
 
-        for shop in database.get_shops():
-            present, price = database.check_book_in_shop(book, shop)
-            _book_data.append(price or "")
+        if column == "Authors":
+            # rows must contain all the filter authors
+            author_rows = [self._author_rows.get(author, set()) for author in value.split(", ")]
+            return set.intersection(*author_rows)
 
-        book_data.append(_book_data)
+        # check filter value is equal to row value
+        return set(self._value_rows[col].get(value, ()))
 
-    if len(database.get_shops()) > 0:
-        book_data.sort(key=lambda x: x[-1] or 0)
+    def apply_filters(self):
+        matches = [rows for rows in self._column_matches if rows is not None]
+        if not matches:
+            self._visible_rows = None
+        else:
+            # intersect the smallest sets first
+            matches.sort(key=len)
+            self._visible_rows = sorted(matches[0].intersection(*matches[1:]))
 
-    library_names = [library.name for library in database.get_libraries()]
-    shop_names = [shop.name for shop in database.get_shops()]
+        self._render()
+
+    def process_event(self, event):
+        if event[:2] == (self.Key, "+CLICKED+"):
+            _, _, (row, col) = event
+            if row == -1:
+                self.prompt(col)
+        elif event == (self.Key, "+SCROLLED+"):
+            self._render_more()
+
+
+def create_table(database: Database):
+    libraries = database.get_libraries()
+    shops = database.get_shops()
+
+    def format_present(present):
+        if present is None:
+            return ""
+        elif present:
+            return "yes"
+        else:
+            return "no"
+
+    def query_rows(order_by: Optional[int], descending: bool, book_filter: BookFilter):
+        pages = database.iter_book_rows(
+            libraries,
+            shops,
+            PAGE_SIZE,
+            order_by=order_by,
+            descending=descending,
+            book_filter=book_filter,
+        )
+        for page in pages:
+            for _, title, read, tags, challenges, authors, *availability in page:
+                presents = availability[:len(libraries)]
+                prices = availability[len(libraries):]
+                row = [
+                    title,
+                    "yes" if read else "no",
+                    tags or "",
+                    challenges or "",
+                    authors or "",
+                ]
+                row.extend(format_present(present) for present in presents)
+                row.extend(price or "" for price in prices)
+
+                yield row
+
+    library_names = [library.name for library in libraries]
+    shop_names = [shop.name for shop in shops]
 
     # create table
     table = FilterTable(
-        book_data,
+        query_rows,
         headings=["Title", "Read", "Tags", "Challenges", "Authors"] + library_names + shop_names,
         enable_click_events=True,
-        size=(800, 600)
+        size=(800, 600),
     )
 
     return table
 
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser(
         "viewer",
         description="View a database in a window."
@@ -130,8 +320,17 @@ def main():
         help="Path to database view.",
         required=False,
     )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print a summary of the database queries made on exit.",
+    )
+
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        query_profiler.enable()
 
-    args = parser.parse_args()
     # TODO: wrap text in table
 
     sg.theme("DarkTeal2")
@@ -146,8 +345,10 @@ def main():
     window = sg.Window(
         "Books",
         layout,
-        size=(800, 600)
+        size=(800, 600),
+        finalize=True,
     )
+    table.watch_scroll(window)
 
     # main loop
     while True: